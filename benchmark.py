@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of descriptor extraction and staging throughput.
+
+Synthetic limbs are generated by perturbing pics/E14.5_L3-03_HL2.5X_LHL.txt
+(random jitter, scale and small rotations), then for each batch size:
+  - every limb is staged with stager.predict() inside an instrument.Instrument
+    block, which times every stage of the pipeline that ships (resampling,
+    the three find_extrema/fit_circle rounds, ribbon area, parabolic fit,
+    calibration lookup), and latency percentiles are reported;
+  - the batched pipeline (descriptors_batch + lookup_many) is timed as a whole
+    and its memory peak is measured with tracemalloc.
+
+Results are written as JSON, pass a previous file with --compare to see the
+ratio new/old of every median latency and throughput:
+    python benchmark.py -o bench_v05.json
+    python benchmark.py --sizes 1 100 --compare bench_v05.json
+"""
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import scipy
+from utils import read_measured_points
+from limbshape import DESCRIPTOR_VERSION, descriptors_batch
+from calibration import get_calibration
+from instrument import Instrument
+from stager import predict, _version
+
+sample_file = "pics/E14.5_L3-03_HL2.5X_LHL.txt"
+STAGES = ("resample", "round 1", "round 2", "round 3", "ribbon", "parabola", "descriptors", "lookup", "total")
+PERCENTILES = (50, 90, 99)
+
+
+#################################################################################
+def synthetic_limbs(n, seed=0, jitter=2.0):
+    """The sample limb plus n-1 perturbed copies of it."""
+    base = read_measured_points(sample_file)
+    rng = np.random.default_rng(seed)
+    limbs = [base]
+    cm = base.mean(axis=0)
+    for _ in range(n - 1):
+        a = rng.normal(0, 0.05)  # radians
+        rot = np.array([[np.cos(a), -np.sin(a), 0], [np.sin(a), np.cos(a), 0], [0, 0, 1]])
+        pts = (base - cm) @ rot.T * rng.uniform(0.9, 1.1) + cm
+        pts[:, :2] += rng.normal(0, jitter, (len(pts), 2))
+        limbs.append(pts)
+    return limbs
+
+
+def time_stages(limbs, calibration, repeat=1):
+    """Stage the limbs with stager.predict() inside an Instrument, returning the
+    wall times in seconds recorded for every stage and the number of failed limbs."""
+    with Instrument() as ins:
+        for _ in range(repeat):
+            for pts in limbs:
+                with ins.timer("total"):
+                    try:
+                        predict(pts, do_plots=False, calibration=calibration)
+                    except (ValueError, TypeError, IndexError) as e:
+                        ins.fail("error", f"{type(e).__name__}: {e}")
+    return ins.times, len(ins.failures)
+
+
+def summarize(values):
+    """Latency percentiles in microseconds."""
+    if not values:
+        return {}
+    us = np.asarray(values) * 1e6
+    summary = {f"p{p}": float(np.percentile(us, p)) for p in PERCENTILES}
+    summary["mean"] = float(us.mean())
+    summary["max"] = float(us.max())
+    return summary
+
+
+def bench_size(limbs, calibration, min_samples=50):
+    """Per-stage latencies of the single-limb pipeline and throughput
+    and memory peak of the batched one."""
+    repeat = max(1, -(-min_samples // len(limbs)))
+    timings, failed = time_stages(limbs, calibration, repeat)
+
+    t0 = time.perf_counter()
+    results = descriptors_batch(limbs)
+    t_desc = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    calibration.lookup_many(results)
+    t_lookup = time.perf_counter() - t0
+
+    tracemalloc.start()
+    calibration.lookup_many(descriptors_batch(limbs))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    n = len(limbs)
+    return dict(
+        n_limbs=n,
+        samples=n * repeat,
+        failed=failed,
+        stages={s: summarize(timings.get(s, [])) for s in STAGES},
+        batch=dict(
+            descriptors_s=t_desc,
+            lookup_s=t_lookup,
+            limbs_per_s=n / (t_desc + t_lookup),
+            memory_peak_mb=peak / 1e6,
+        ),
+    )
+
+
+#################################################################################
+def compare(new, old):
+    """Print the ratio new/old of median latencies and batch throughput."""
+    print(f"\nComparison with {old['version']} ({old['date']}), ratio new/old:")
+    for size, rnew in new["sizes"].items():
+        rold = old["sizes"].get(size)
+        if not rold:
+            continue
+        cells = []
+        for s in STAGES:
+            a = rnew["stages"].get(s, {}).get("p50")
+            b = rold["stages"].get(s, {}).get("p50")
+            if a and b:
+                cells.append(f"{s} {a / b:.2f}")
+        thr = rnew["batch"]["limbs_per_s"] / rold["batch"]["limbs_per_s"]
+        print(f"  {size:>6} limbs: p50 " + ", ".join(cells) + f" | batch throughput {thr:.2f}")
+
+
+def print_report(report):
+    for size, r in report["sizes"].items():
+        b = r["batch"]
+        print(f"\n{size} limbs ({r['samples']} timed, {r['failed']} failed)")
+        print(f"  {'stage':<13}" + "".join(f"{k:>10}" for k in ("p50", "p90", "p99", "max")) + "  [us]")
+        for s in STAGES:
+            st = r["stages"][s]
+            if st:
+                print(f"  {s:<13}" + "".join(f"{st[k]:10.1f}" for k in ("p50", "p90", "p99", "max")))
+        print(
+            f"  batch: {b['limbs_per_s']:.0f} limbs/s"
+            f" (descriptors {b['descriptors_s']:.3f}s, lookup {b['lookup_s']:.4f}s),"
+            f" memory peak {b['memory_peak_mb']:.1f} MB"
+        )
+
+
+#################################################################################
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="welsh_stager benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 100, 10000])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", default="benchmark.json", help="output JSON file")
+    parser.add_argument("--compare", default="", help="previous JSON file to compare with")
+    args = parser.parse_args()
+
+    calibration = get_calibration()
+    limbs = synthetic_limbs(max(args.sizes), seed=args.seed)
+    # warm up: load the calibration and the lazy imports outside of the timings
+    time_stages(limbs[:1], calibration)
+    descriptors_batch(limbs[:1])
+
+    report = dict(
+        version=_version,
+        descriptor_version=DESCRIPTOR_VERSION,
+        date=datetime.now().isoformat(timespec="seconds"),
+        machine=dict(
+            python=platform.python_version(),
+            numpy=np.__version__,
+            scipy=scipy.__version__,
+            platform=platform.platform(),
+            processor=platform.processor(),
+        ),
+        sizes={},
+    )
+    for n in args.sizes:
+        report["sizes"][str(n)] = bench_size(limbs[:n], calibration)
+
+    print_report(report)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"\nResults saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
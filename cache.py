@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+import sqlite3
+import time
+import numpy as np
+from limbshape import DESCRIPTOR_VERSION
+
+
+#################################################################################
+class DescriptorCache:
+    """On-disk cache of limb descriptors stored in a SQLite file.
+
+    Entries are keyed by a hash of the MEASURED points, of the options used to
+    compute them and of limbshape.DESCRIPTOR_VERSION, so a limb is recomputed
+    only if its points or the descriptor code change. Entries written by
+    another code version are dropped on open, and the least recently used
+    entries are evicted when the cache grows beyond max_entries.
+    """
+
+    def __init__(self, filename, max_entries=200000):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(filename)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS descriptors ("
+            " key TEXT PRIMARY KEY, version TEXT, area REAL, aratio REAL,"
+            " parabolic REAL, last_used REAL)"
+        )
+        self.db.execute("DELETE FROM descriptors WHERE version != ?", (DESCRIPTOR_VERSION,))
+        self.db.commit()
+
+    @staticmethod
+    def key(datapoints, **options):
+        """Hash of the points and of the options used to compute the descriptors."""
+        h = hashlib.sha1(np.ascontiguousarray(datapoints, dtype=np.float64).tobytes())
+        h.update(repr(sorted(options.items())).encode())
+        h.update(DESCRIPTOR_VERSION.encode())
+        return h.hexdigest()
+
+    def get_many(self, keys):
+        """Return a dict key -> descriptor array for the keys found in the cache."""
+        found = {}
+        keys = list(keys)
+        for i in range(0, len(keys), 500):  # stay below the sqlite variables limit
+            chunk = keys[i : i + 500]
+            q = ",".join("?" * len(chunk))
+            rows = self.db.execute(
+                f"SELECT key, area, aratio, parabolic FROM descriptors WHERE key IN ({q})", chunk
+            )
+            for k, area, aratio, parabolic in rows:
+                found[k] = np.array([area, aratio, parabolic])
+            self.db.execute(
+                f"UPDATE descriptors SET last_used=? WHERE key IN ({q})", [time.time()] + chunk
+            )
+        self.db.commit()
+        return found
+
+    def put_many(self, items):
+        """Store (key, descriptor array) pairs and evict old entries if needed."""
+        now = time.time()
+        self.db.executemany(
+            "INSERT OR REPLACE INTO descriptors VALUES (?, ?, ?, ?, ?, ?)",
+            [(k, DESCRIPTOR_VERSION, *map(float, r), now) for k, r in items],
+        )
+        self.evict()
+        self.db.commit()
+
+    def evict(self):
+        n = len(self)
+        if n > self.max_entries:
+            self.db.execute(
+                "DELETE FROM descriptors WHERE key IN"
+                " (SELECT key FROM descriptors ORDER BY last_used LIMIT ?)",
+                (n - self.max_entries,),
+            )
+
+    def clear(self):
+        self.db.execute("DELETE FROM descriptors")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM descriptors").fetchone()[0]
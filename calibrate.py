@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless and incremental builder of the calibration curve.
+
+Same steps as stager.generate_calibration_welsh(), without any window:
+descriptors of the training limbs -> two moving least squares passes over the
+cloud of descriptors (as vedo smoothMLS1D(f=1.2)) -> subsample (as vedo
+subsample(0.05)) -> sort by area -> spline -> step/age table.
+
+Writes calibration_spline_welsh.vtk and calibration_table_welsh.vtk, plus
+calibration_welsh.npz holding the spline, the table and the state of the
+build. Running it again on the same directory only computes the descriptors
+of new or modified limbs, and re-smooths only the points of the cloud whose
+neighbourhood has changed.
+
+Usage:
+    python calibrate.py data/staged_welsh_reduced/ --outdir .
+    python calibrate.py data/staged_welsh_reduced/ --full   # ignore the saved state
+"""
+import os
+import time
+import argparse
+from glob import glob
+from functools import partial
+import numpy as np
+from scipy.spatial import cKDTree
+from utils import Limb, parallel_map
+from limbshape import DESCRIPTOR_VERSION, outline_descriptors, resample_outline
+from cache import DescriptorCache
+from calibration import write_vtk_line
+
+# step along the calibration spline -> average age at that point
+# (the first and last agegroups are extrapolations)
+CALIBRATION_IDS = np.array([0, 6, 11, 21, 44, 64, 77, 99])
+CALIBRATION_AGEGROUPS = np.array([318, 324, 330, 336, 342, 348, 354, 366])
+
+
+#################################################################################
+def _mls_neighbours(cloud, f):
+    return max(int(len(cloud) * f / 10), 5)
+
+
+def mls_1d(cloud, f=1.2, ids=None):
+    """Moving least squares smoothing of a point cloud along its main direction
+    (as vedo smoothMLS1D): each point is projected on the line that best fits
+    its n nearest neighbours. Only the points in ids are computed if given.
+
+    Returns the new points, the neighbour ids and the distance to the
+    farthest neighbour of each computed point."""
+    cloud = np.asarray(cloud, dtype=float)
+    ids = np.arange(len(cloud)) if ids is None else np.asarray(ids, dtype=int)
+    n = _mls_neighbours(cloud, f)
+    radius, nbr = cKDTree(cloud).query(cloud[ids], k=n)
+    pts = cloud[nbr]
+    mean = pts.mean(axis=1)
+    _, _, vv = np.linalg.svd(pts - mean[:, None, :], full_matrices=False)
+    d = vv[:, 0, :]
+    out = ((cloud[ids] - mean) * d).sum(axis=1)[:, None] * d + mean
+    return out, nbr, radius[:, -1]
+
+
+def mls_1d_update(cloud, changed, prev, f=1.2):
+    """Incremental mls_1d().
+
+    prev is the (out, nbr, radius) of the previous call aligned to the new
+    cloud (rows of new points and neighbour ids of removed points set to -1),
+    changed marks the points that are new or have moved. A point is recomputed
+    only if it changed, if one of its neighbours changed or was removed, or if
+    a changed point now falls inside its neighbourhood.
+    Returns out, nbr, radius and the number of recomputed points."""
+    cloud = np.asarray(cloud, dtype=float)
+    out, nbr, radius = (np.array(a) for a in prev)
+    if nbr.shape[1] != _mls_neighbours(cloud, f):
+        out, nbr, radius = mls_1d(cloud, f)
+        return out, nbr, radius, len(cloud)
+
+    moved = np.r_[changed, True]  # so that nbr == -1 counts as changed
+    dirty = changed | moved[nbr].any(axis=1)
+    if changed.any():
+        tree = cKDTree(cloud[changed])
+        clean = np.flatnonzero(~dirty)
+        inside = tree.query_ball_point(cloud[clean], radius[clean], return_length=True)
+        dirty[clean[inside > 0]] = True
+
+    ids = np.flatnonzero(dirty)
+    if len(ids):
+        out[ids], nbr[ids], radius[ids] = mls_1d(cloud, f, ids)
+    return out, nbr, radius, len(ids)
+
+
+def smooth_cloud(cloud, f=1.2):
+    """The two mls_1d() passes of the calibration, as a list of (out, nbr, radius)."""
+    first = mls_1d(cloud, f)
+    return [first, mls_1d(first[0], f)]
+
+
+def smooth_subset(cloud, passes, keep, f=1.2):
+    """smooth_cloud(cloud[keep]) from the passes over the whole cloud, recomputing
+    only the points that had a dropped point among their neighbours (and the
+    points that depend on those in the second pass)."""
+    ids = np.flatnonzero(keep)
+    remap = -np.ones(len(keep), dtype=int)  # old id -> new id, -1 for dropped
+    remap[ids] = np.arange(len(ids))
+    changed = np.zeros(len(ids), dtype=bool)
+    points = np.asarray(cloud, dtype=float)[ids]
+    result = []
+    for out, nbr, radius in passes:
+        prev = (out[ids], remap[nbr[ids]], radius[ids])
+        new_out, new_nbr, new_radius, _ = mls_1d_update(points, changed, prev, f)
+        changed = changed | np.any(new_out != prev[0], axis=1)
+        result.append((new_out, new_nbr, new_radius))
+        points = new_out
+    return result
+
+
+def subsample(points, fraction=0.05):
+    """Merge points closer than fraction times the diagonal of the bounding box,
+    keeping the first one in order (as vedo subsample / vtkCleanPolyData)."""
+    points = np.asarray(points, dtype=float)
+    tol = fraction * np.linalg.norm(points.max(axis=0) - points.min(axis=0))
+    kept = []
+    for i, p in enumerate(points):
+        if not kept or np.min(np.linalg.norm(points[kept] - p, axis=1)) > tol:
+            kept.append(i)
+    return points[kept]
+
+
+def calibration_curve(cloud, smooth=0.1, ids=CALIBRATION_IDS, agegroups=CALIBRATION_AGEGROUPS):
+    """Calibration spline through a smoothed cloud of descriptors and the
+    step/age table, as two (100, 3) arrays."""
+    pts = subsample(cloud, 0.05)  # heavily subsample
+    pts = pts[np.argsort(pts[:, 0], kind="stable")]  # order by increasing area
+    spline = resample_outline(pts, res=100, smooth=smooth)  ###### DONT CHANGE 100
+    table = resample_outline(np.c_[ids, agegroups], res=100)
+    return spline, table
+
+
+def _unique_index(ids):
+    # position of each id that occurs only once
+    u, inv, counts = np.unique(ids, return_inverse=True, return_counts=True)
+    return {u[j]: i for i, j in enumerate(inv) if counts[j] == 1}
+
+
+#################################################################################
+class CalibrationBuilder:
+    """Build the calibration spline and table from a directory of staged limbs,
+    keeping the intermediate results so that it can be updated incrementally."""
+
+    def __init__(self, smooth=0.1, mls_f=1.2, state_file=None):
+        self.smooth = smooth
+        self.mls_f = mls_f
+        self.names = np.array([], dtype=str)
+        self.keys = np.array([], dtype=str)
+        self.results = np.zeros((0, 3))
+        self.ages = np.zeros(0, dtype=int)
+        self._mls = [None, None]  # (out, nbr, radius) of the two passes
+        self.spline = None
+        self.table = None
+        self.timings = {}
+        if state_file and os.path.isfile(state_file):
+            self.load_state(state_file)
+
+    def load_state(self, filename):
+        with np.load(filename) as data:
+            if str(data["descriptor_version"]) != DESCRIPTOR_VERSION or float(data["mls_f"]) != self.mls_f:
+                print(f"{filename} was built with different settings, rebuilding from scratch")
+                return
+            self.names, self.keys = data["names"], data["keys"]
+            self.results, self.ages = data["results"], data["ages"]
+            self._mls = [
+                (data[f"mls{k}_out"], data[f"mls{k}_nbr"], data[f"mls{k}_radius"]) for k in (1, 2)
+            ]
+
+    def _timed(self, phase, t0):
+        self.timings[phase] = self.timings.get(phase, 0) + time.perf_counter() - t0
+        return time.perf_counter()
+
+    def update(self, source, workers=None):
+        """Synchronize with the limbs in source (directory or list of files).
+        Returns the number of added and removed limbs."""
+        t0 = time.perf_counter()
+        if isinstance(source, str):
+            source = glob(os.path.join(source, "*.txt"))
+        filenames = sorted(source)
+        limbs = [Limb(f, author="welsh") for f in filenames]
+        names = np.array([os.path.basename(f) for f in filenames], dtype=str)
+        keys = np.array([DescriptorCache.key(l.datapoints, presample=True) for l in limbs], dtype=str)
+        t0 = self._timed("read", t0)
+
+        old = {k: i for i, k in enumerate(self.keys)}
+        todo = [i for i, k in enumerate(keys) if k not in old]
+        results = np.zeros((len(limbs), 3))
+        for i, k in enumerate(keys):
+            if k in old:
+                results[i] = self.results[old[k]]
+        func = partial(outline_descriptors, presample=True)
+        new = parallel_map(func, [limbs[i].datapoints for i in todo], workers=workers)
+        for i, res in zip(todo, new):
+            results[i] = res
+        t0 = self._timed("descriptors", t0)
+
+        good = results[:, 0] != 0
+        for f in np.array(filenames)[~good]:
+            print("Error: zero area for", f)
+        # a limb is identified by file name and points: copies of a file are distinct limbs
+        ids, old_ids = self._ids(names, keys), set(self._ids(self.names, self.keys))
+        nadded = len(set(ids) - old_ids)
+        nremoved = len(old_ids - set(ids))
+        self._update_cloud(ids[good], results[good])
+        self.names, self.keys, self.results = names[good], keys[good], results[good]
+        self.ages = np.array([l.age for l in limbs])[good]
+        return nadded, nremoved
+
+    @staticmethod
+    def _ids(names, keys):
+        return np.array([f"{n}|{k}" for n, k in zip(names, keys)], dtype=str)
+
+    def _update_cloud(self, ids, cloud):
+        # the two smoothing passes, recomputing only what is needed;
+        # ids that are not unique are recomputed as new points
+        t0 = time.perf_counter()
+        old = _unique_index(self._ids(self.names, self.keys))
+        new = _unique_index(ids)
+        oldids = np.array([old.get(k, -1) if k in new else -1 for k in ids], dtype=int)
+        remap = -np.ones(len(self.keys) + 1, dtype=int)  # old id -> new id, -1 for removed
+        remap[oldids[oldids >= 0]] = np.flatnonzero(oldids >= 0)
+
+        changed = oldids < 0
+        for k in range(2):
+            prev = self._mls[k]
+            if prev is None or not len(self.keys):
+                out, nbr, radius = mls_1d(cloud, self.mls_f)
+                nrecomputed = len(cloud)
+            else:
+                out = np.zeros((len(cloud), 3))
+                nbr = -np.ones((len(cloud), prev[1].shape[1]), dtype=int)
+                radius = np.zeros(len(cloud))
+                kept = oldids >= 0
+                out[kept] = prev[0][oldids[kept]]
+                nbr[kept] = remap[prev[1][oldids[kept]]]
+                radius[kept] = prev[2][oldids[kept]]
+                previous = out.copy()
+                out, nbr, radius, nrecomputed = mls_1d_update(
+                    cloud, changed, (out, nbr, radius), self.mls_f
+                )
+                # points that moved are the input changes of the next pass
+                changed = changed | np.any(out != previous, axis=1)
+            self._mls[k] = (out, nbr, radius)
+            cloud = out
+            print(f"Smoothing pass {k+1}: {nrecomputed}/{len(cloud)} points recomputed")
+            t0 = self._timed(f"smoothing pass {k+1}", t0)
+
+    def build(self):
+        """Compute the calibration spline and table from the smoothed cloud."""
+        t0 = time.perf_counter()
+        self.spline, self.table = calibration_curve(self._mls[1][0], self.smooth)
+        self._timed("spline", t0)
+        return self.spline, self.table
+
+    def save(self, outdir="."):
+        """Write the .vtk spline and table and the compact .npz file."""
+        t0 = time.perf_counter()
+        spline_file = write_vtk_line(os.path.join(outdir, "calibration_spline_welsh.vtk"), self.spline)
+        table_file = write_vtk_line(os.path.join(outdir, "calibration_table_welsh.vtk"), self.table)
+        npz_file = os.path.join(outdir, "calibration_welsh.npz")
+        np.savez_compressed(
+            npz_file,
+            spline=self.spline,
+            table=self.table,
+            names=self.names,
+            keys=self.keys,
+            results=self.results,
+            ages=self.ages,
+            mls_f=self.mls_f,
+            descriptor_version=DESCRIPTOR_VERSION,
+            **{f"mls{k+1}_{n}": a for k in range(2) for n, a in zip(("out", "nbr", "radius"), self._mls[k])},
+        )
+        self._timed("write", t0)
+        return spline_file, table_file, npz_file
+
+    def report(self):
+        total = sum(self.timings.values())
+        lines = [f"{phase:<20}{t:8.3f}s" for phase, t in self.timings.items()]
+        lines.append(f"{'total':<20}{total:8.3f}s")
+        return "\n".join(lines)
+
+
+#################################################################################
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="welsh_stager calibration builder")
+    parser.add_argument("source", help="directory of staged limb .txt files")
+    parser.add_argument("--outdir", default=".", help="where to write the calibration files")
+    parser.add_argument("--smooth", type=float, default=0.1, help="smoothing of the calibration spline")
+    parser.add_argument("--full", action="store_true", help="ignore the saved state and rebuild")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    state = None if args.full else os.path.join(args.outdir, "calibration_welsh.npz")
+    builder = CalibrationBuilder(smooth=args.smooth, state_file=state)
+    nadded, nremoved = builder.update(args.source, workers=args.workers)
+    print(f"{len(builder.keys)} limbs in the calibration cloud ({nadded} new, {nremoved} removed)")
+    builder.build()
+    for f in builder.save(args.outdir):
+        print("calibration saved to:", f)
+    print(builder.report())
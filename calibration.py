@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+from scipy.spatial import cKDTree
+
+tuningdir = "tuning"
+
+
+def read_vtk_points(filename):
+    """Read the POINTS of a legacy .vtk polydata file (ascii or binary) with numpy,
+    so that staging does not need to load VTK. Falls back to vedo for other formats."""
+    with open(filename, "rb") as f:
+        data = f.read()
+    lines = data.split(b"\n", 4)
+    if len(lines) == 5 and lines[0].startswith(b"# vtk DataFile") and lines[3].strip() == b"DATASET POLYDATA":
+        binary = lines[2].strip() == b"BINARY"
+        pos = data.find(b"\nPOINTS ")
+        if pos >= 0:
+            end = data.index(b"\n", pos + 1)
+            _, n, dtype = data[pos + 1 : end].split()
+            n = int(n)
+            dt = {b"double": ">f8", b"float": ">f4"}.get(dtype)
+            if dt:
+                if binary:
+                    pts = np.frombuffer(data, dtype=dt, count=3 * n, offset=end + 1)
+                else:
+                    pts = np.array(data[end + 1 :].split()[: 3 * n], dtype=float)
+                return pts.astype(float).reshape(n, 3)
+    from vedo import load
+
+    return np.asarray(load(filename).vertices)
+
+
+def write_vtk_line(filename, points):
+    """Write points as a single polyline in a legacy binary .vtk polydata file."""
+    points = np.asarray(points, dtype=float)
+    if points.shape[1] == 2:
+        points = np.c_[points, np.zeros(len(points))]
+    n = len(points)
+    with open(filename, "wb") as f:
+        f.write(b"# vtk DataFile Version 4.2\nvtk output\nBINARY\nDATASET POLYDATA\n")
+        f.write(f"POINTS {n} double\n".encode())
+        f.write(points.astype(">f8").tobytes())
+        f.write(f"\nLINES 1 {n + 1}\n".encode())
+        f.write(np.r_[n, np.arange(n)].astype(">i4").tobytes())
+        f.write(b"\n")
+    return filename
+
+
+#################################################################################
+class Calibration:
+    """Calibration spline (time course in descriptor space) and step->age table.
+
+    Files are parsed lazily on first use and kept in memory, so that many
+    predict() calls share a single load. Use reload() to force a new parse
+    or refresh() to reload only if the files on disk have changed.
+    A compact .npz calibration (see calibrate.py) can be given as spline_file,
+    in which case table_file is ignored, or the arrays with from_arrays().
+    """
+
+    def __init__(
+        self,
+        spline_file=os.path.join(tuningdir, "calibration_spline.vtk"),
+        table_file=os.path.join(tuningdir, "calibration_table.vtk"),
+    ):
+        self.spline_file = spline_file
+        self.table_file = spline_file if spline_file.endswith(".npz") else table_file
+        self._spline = None
+        self._vertices = None
+        self._table = None
+        self._index = None
+        self._step_ages = None
+        self._mtimes = None
+
+    @classmethod
+    def from_arrays(cls, spline, table):
+        """A Calibration from the points of the curve and of the table, without files."""
+        calibration = cls(spline_file="", table_file="")
+        calibration._vertices = np.asarray(spline, dtype=float)
+        calibration._table = np.asarray(table, dtype=float)
+        return calibration
+
+    def _file_mtimes(self):
+        return (os.path.getmtime(self.spline_file), os.path.getmtime(self.table_file))
+
+    def _load(self):
+        self._mtimes = self._file_mtimes()
+        if self.spline_file.endswith(".npz"):
+            with np.load(self.spline_file) as data:
+                self._vertices = data["spline"]
+                self._table = data["table"]
+            return
+        self._vertices = read_vtk_points(self.spline_file)
+        self._table = read_vtk_points(self.table_file)
+
+    @property
+    def spline(self):
+        """The calibration curve as a vedo Line, for plotting (do not modify, clone it)."""
+        if self._spline is None:
+            from vedo import load, Line
+
+            self.vertices  # make sure the mtimes refer to what is loaded
+            if not self.spline_file or self.spline_file.endswith(".npz"):
+                self._spline = Line(self.vertices)
+            else:
+                self._spline = load(self.spline_file)
+        return self._spline
+
+    @property
+    def vertices(self):
+        """The points of the calibration curve as an (N, 3) array."""
+        if self._vertices is None:
+            self._load()
+        return self._vertices
+
+    @property
+    def table(self):
+        """The calibration table as an array of (step, age, 0) points."""
+        if self._table is None:
+            self._load()
+        return self._table
+
+    def is_loaded(self):
+        return self._vertices is not None
+
+    def is_stale(self):
+        """True if the files in tuning/ changed since they were loaded."""
+        if not self.is_loaded() or not self.spline_file:
+            return False
+        try:
+            return self._file_mtimes() != self._mtimes
+        except OSError:
+            return True
+
+    def invalidate(self):
+        """Drop the cached data, next access will read the files again."""
+        self._spline = None
+        self._vertices = None
+        self._table = None
+        self._index = None
+        self._step_ages = None
+        self._mtimes = None
+
+    def reload(self):
+        self.invalidate()
+        self._load()
+        return self
+
+    def refresh(self):
+        """Reload only if the files on disk have changed."""
+        if self.is_stale():
+            self.reload()
+        return self
+
+    @property
+    def index(self):
+        """KD-tree over the points of the calibration curve."""
+        if self._index is None:
+            self._index = cKDTree(self.vertices)
+        return self._index
+
+    @property
+    def step_ages(self):
+        """Age of each point (step) along the calibration curve.
+
+        Each step takes the age of the closest entry of the calibration table,
+        the same rule that predict() has always applied per embryo.
+        """
+        if self._step_ages is None:
+            steps = np.arange(len(self.vertices))
+            calib = self.table
+            idt = np.abs(calib[:, 0][None, :] - steps[:, None]).argmin(axis=1)
+            self._step_ages = np.round(calib[idt, 1]).astype(int)
+        return self._step_ages
+
+    def lookup_many(self, results, sigma_factor=1.2):
+        """Vectorized lookup of an (N, 3) array of descriptor vectors.
+
+        Returns a dict of arrays: the id of the closest point on the curve
+        (step), the point itself (q), the age, the heuristic sigma and the
+        score (distance to the curve).
+        """
+        results = np.atleast_2d(np.asarray(results, dtype=float))
+        best_score, idn = self.index.query(results)
+        # count curve points within sigma_factor times the distance to the closest one
+        counts = self.index.query_ball_point(results, best_score * sigma_factor, return_length=True)
+        sigma = np.round((counts + 1) / 2).astype(int)  # heuristic
+        return dict(
+            step=idn,
+            q=self.vertices[idn],
+            age=self.step_ages[idn],
+            sigma=sigma,
+            score=best_score,
+        )
+
+    def lookup(self, result):
+        """Map a single descriptor vector onto the calibration curve.
+
+        Returns the id of the closest point on the curve, the point itself,
+        the age, the heuristic sigma and the score (distance to the curve).
+        """
+        res = self.lookup_many([result])
+        return (
+            int(res["step"][0]),
+            res["q"][0],
+            int(res["age"][0]),
+            int(res["sigma"][0]),
+            float(res["score"][0]),
+        )
+
+
+_default_calibration = None
+
+
+def get_calibration():
+    """Return the shared default Calibration, reloaded if tuning/ files changed."""
+    global _default_calibration
+    if _default_calibration is None:
+        _default_calibration = Calibration()
+    return _default_calibration.refresh()
+
+
+def set_calibration(calibration):
+    """Replace the shared default Calibration (e.g. to inject a custom one)."""
+    global _default_calibration
+    _default_calibration = calibration
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cross-validation of the calibration curve, to measure the real staging error.
+
+The descriptors of the staged limbs are computed once (both as used to build
+the calibration and as used to stage a new limb). For every fold the limbs
+of the held-out groups are removed from the cloud of descriptors, the two
+smoothing passes are updated only where a removed limb was a neighbour, the
+calibration spline is refitted and the held-out limbs are staged against it
+with a vectorized lookup. Folds run in worker processes.
+
+Folds are made of whole groups: by default one fold per litterID (leave one
+litter out), --folds k makes k folds of litters, --group limb gives the plain
+leave-one-out. Errors are summarized per nominal age group.
+
+Usage:
+    python crossval.py data/staged_welsh_reduced/ -o crossval.csv
+    python crossval.py data/staged_welsh_reduced/ --folds 10
+    python crossval.py data/staged_welsh_reduced/ --group limb
+"""
+import os
+import csv
+import time
+import argparse
+from glob import glob
+from functools import partial
+import numpy as np
+from utils import Limb, parallel_map
+from limbshape import resample_outlines, descriptors_batch
+from calibration import Calibration
+from calibrate import smooth_cloud, smooth_subset, calibration_curve
+from sweep import age_metrics, METRICS
+
+
+#################################################################################
+def make_folds(groups, k=0, seed=0):
+    """Indices of the held-out limbs of each fold: one fold per group,
+    or k folds made of randomly assigned whole groups."""
+    names, gid = np.unique(groups, return_inverse=True)
+    if 0 < k < len(names):
+        assign = np.empty(len(names), dtype=int)
+        assign[np.random.default_rng(seed).permutation(len(names))] = np.arange(len(names)) % k
+    else:
+        assign = np.arange(len(names))
+    return [np.flatnonzero(assign[gid] == f) for f in range(assign.max() + 1)]
+
+
+def _refit_fold(job, cloud, ids, passes, stage_results, smooth, mls_f):
+    # runs in a worker: calibration without the limbs of the fold, then stage
+    # the ones that have staging descriptors
+    fold, staged = job
+    keep = ~np.isin(ids, fold)  # ids: limb of each point of the cloud
+    smoothed = smooth_subset(cloud, passes, keep, mls_f)[1][0]
+    calibration = Calibration.from_arrays(*calibration_curve(smoothed, smooth))
+    return calibration.lookup_many(stage_results[staged])
+
+
+def cross_validate(datapoints_list, folds, smooth=0.1, mls_f=1.2, workers=None):
+    """Stage every limb with a calibration built without its fold.
+    Returns a dict of arrays: fold, age, sigma and chi2 (age 0 for failed limbs),
+    and age_insample, sigma_insample with the calibration built on all the limbs."""
+    # as in training_descriptors(presample=True) for the calibration,
+    # as in stage_many() for the staging of the held-out limbs
+    outlines, ok = resample_outlines(datapoints_list, res=200)
+    cal_results = descriptors_batch([o if k else [] for o, k in zip(outlines, ok)])
+    stage_results = descriptors_batch(datapoints_list)
+
+    ids = np.flatnonzero(cal_results[:, 0] != 0)
+    cloud = cal_results[ids]
+    passes = smooth_cloud(cloud, mls_f)
+    jobs = [(f, f[stage_results[f, 0] != 0]) for f in folds]
+    func = partial(_refit_fold, cloud=cloud, ids=ids, passes=passes,
+                   stage_results=stage_results, smooth=smooth, mls_f=mls_f)
+    n = len(datapoints_list)
+    out = dict(fold=np.full(n, -1), age=np.zeros(n, dtype=int), sigma=np.zeros(n, dtype=int), chi2=np.zeros(n))
+    for k, ((_, test), res) in enumerate(zip(jobs, parallel_map(func, jobs, workers=workers))):
+        out["fold"][folds[k]] = k
+        out["age"][test] = res["age"]
+        out["sigma"][test] = res["sigma"]
+        out["chi2"][test] = res["score"]
+
+    # in-sample reference: calibration built on all the limbs
+    full = Calibration.from_arrays(*calibration_curve(passes[1][0], smooth))
+    good = stage_results[:, 0] != 0
+    res = full.lookup_many(stage_results[good])
+    out["age_insample"] = np.zeros(n, dtype=int)
+    out["age_insample"][good] = res["age"]
+    out["sigma_insample"] = np.zeros(n, dtype=int)
+    out["sigma_insample"][good] = res["sigma"]
+    return out
+
+
+def summarize(nominal, pred):
+    """Error metrics per nominal age group and overall (key "all")."""
+    staged = pred["age"] > 0
+    summary = {}
+    for age in list(np.unique(nominal)) + ["all"]:
+        sel = np.ones(len(nominal), dtype=bool) if age == "all" else nominal == age
+        ok = sel & staged
+        summary[age] = age_metrics(pred["age"][ok], nominal[ok], pred["sigma"][ok], sel.sum())
+    return summary
+
+
+def write_predictions(filename, names, groups, nominal, pred):
+    columns = ["name", "group", "fold", "nominal_age", "age", "error", "sigma", "chi2", "age_insample"]
+    with open(filename, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for i, name in enumerate(names):
+            err = pred["age"][i] - nominal[i] if pred["age"][i] else ""
+            writer.writerow([name, groups[i], pred["fold"][i], nominal[i], pred["age"][i], err,
+                             pred["sigma"][i], pred["chi2"][i], pred["age_insample"][i]])
+
+
+def write_summary(filename, summary):
+    with open(filename, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["nominal_age"] + METRICS)
+        writer.writeheader()
+        for age, metrics in summary.items():
+            writer.writerow(dict(nominal_age=age, **metrics))
+
+
+#################################################################################
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="welsh_stager cross-validation")
+    parser.add_argument("source", help="directory of staged limb .txt files")
+    parser.add_argument("-o", "--output", default="crossval.csv",
+                        help="csv of the per-limb predictions, the per-age summary goes to <name>_by_age.csv")
+    parser.add_argument("--group", choices=("litter", "limb"), default="litter",
+                        help="keep the limbs of a litter in the same fold, or leave one limb out")
+    parser.add_argument("--folds", type=int, default=0, help="number of folds (default: one per group)")
+    parser.add_argument("--smooth", type=float, default=0.1, help="smoothing of the calibration spline")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    filenames = sorted(glob(os.path.join(args.source, "*.txt")))
+    limbs = [Limb(f, author="welsh") for f in filenames]
+    names = [os.path.basename(f) for f in filenames]
+    nominal = np.array([limb.age for limb in limbs])
+    groups = np.array([limb.litterID for limb in limbs]) if args.group == "litter" else np.array(names)
+    folds = make_folds(groups, args.folds, args.seed)
+    print(f"{len(limbs)} limbs, {len(np.unique(groups))} groups, {len(folds)} folds")
+
+    pred = cross_validate([limb.datapoints for limb in limbs], folds, args.smooth, workers=args.workers)
+    summary = summarize(nominal, pred)
+    ok = pred["age_insample"] > 0
+    insample = age_metrics(pred["age_insample"][ok], nominal[ok], pred["sigma_insample"][ok], len(nominal))
+
+    print(f"{'nominal age':>12}{'limbs':>7}{'failed %':>10}{'MAE h':>8}{'bias h':>8}{'RMSE h':>8}"
+          f"{'max h':>7}{'in sigma %':>12}")
+    for age, m in summary.items():
+        label = age if age == "all" else f"{age}h"
+        print(f"{label:>12}{m['staged']:>7}{100 * m['failure_rate']:>10.1f}{m['mae']:>8.1f}{m['bias']:>8.1f}"
+              f"{m['rmse']:>8.1f}{m['max_error']:>7.0f}{100 * m['coverage']:>12.1f}")
+    print(f"in-sample MAE {insample['mae']:.1f}h, cross-validated MAE {summary['all']['mae']:.1f}h")
+
+    write_predictions(args.output, names, groups, nominal, pred)
+    by_age = os.path.splitext(args.output)[0] + "_by_age.csv"
+    write_summary(by_age, summary)
+    print(f"Predictions saved to {args.output}, summary to {by_age}")
+    print(f"Cross-validation done in {time.perf_counter() - t0:.1f}s")
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Opt-in instrumentation of the staging pipeline.
+
+Wall time of every stage (resampling, the three find_extrema/fit_circle
+rounds, ribbon area, parabolic fit, calibration lookup), counters and the
+reason why limbs fail (which round, no peaks / no valleys / zero radius)
+are recorded only inside an Instrument block:
+
+    from instrument import Instrument
+    with Instrument() as ins:
+        rows = stage_batch(filenames)
+    print(ins.report())
+    ins.save("timings.json")
+
+A callback(kind, name, value) can also be given to receive every event as it
+happens, kind being "time", "count" or "fail".
+When no Instrument is active the pipeline talks to a null object whose
+methods do nothing, so the cost is one function call per stage.
+"""
+import json
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+import numpy as np
+
+_current = ContextVar("welsh_stager_instrument", default=None)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class _NullInstrument:
+    """Does nothing, used when instrumentation is disabled."""
+
+    _timer = _NullTimer()
+
+    def __bool__(self):
+        return False
+
+    def timer(self, name):
+        return self._timer
+
+    def add_time(self, name, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def fail(self, stage, reason, limb=None):
+        pass
+
+
+_NULL = _NullInstrument()
+
+
+def current():
+    """The active Instrument, or a null instrument if none is active."""
+    return _current.get() or _NULL
+
+
+@contextmanager
+def paused():
+    """Nothing is recorded inside this block, e.g. while staging internal replicates."""
+    token = _current.set(None)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+class _Timer:
+    __slots__ = ("instrument", "name", "t0")
+
+    def __init__(self, instrument, name):
+        self.instrument = instrument
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.instrument.add_time(self.name, time.perf_counter() - self.t0)
+        return False
+
+
+#################################################################################
+class Instrument:
+    """Collect stage timings, counters and failures while it is active."""
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.times = {}  # stage name -> list of durations in seconds
+        self.counts = {}
+        self.failures = []  # dicts with stage, reason and limb index (or name)
+        self._token = None
+
+    def __bool__(self):
+        return True
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, *args):
+        _current.reset(self._token)
+        self._token = None
+        return False
+
+    def timer(self, name):
+        """Context manager adding its wall time to stage name."""
+        return _Timer(self, name)
+
+    def add_time(self, name, seconds):
+        self.times.setdefault(name, []).append(seconds)
+        if self.callback:
+            self.callback("time", name, seconds)
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+        if self.callback:
+            self.callback("count", name, n)
+
+    def fail(self, stage, reason, limb=None):
+        """Record that a limb could not be staged at stage, e.g. ("round 2", "zero radius")."""
+        failure = dict(stage=stage, reason=reason, limb=limb)
+        self.failures.append(failure)
+        if self.callback:
+            self.callback("fail", stage, failure)
+
+    def summary(self, bins=10):
+        """Aggregated results as a dict that can be saved as JSON.
+
+        For each stage: number of calls, total time, latency percentiles
+        and a histogram with logarithmic bins (all in microseconds).
+        """
+        stages = {}
+        for name, values in self.times.items():
+            us = np.asarray(values) * 1e6
+            lo, hi = max(us.min(), 0.1), max(us.max(), 0.2)
+            counts, edges = np.histogram(us, bins=np.geomspace(lo, hi * 1.0001, bins + 1))
+            stages[name] = dict(
+                calls=len(us),
+                total_s=float(us.sum() / 1e6),
+                mean_us=float(us.mean()),
+                p50_us=float(np.percentile(us, 50)),
+                p90_us=float(np.percentile(us, 90)),
+                p99_us=float(np.percentile(us, 99)),
+                max_us=float(us.max()),
+                histogram=dict(edges_us=edges.tolist(), counts=counts.tolist()),
+            )
+        by_reason = {}
+        for f in self.failures:
+            key = f"{f['stage']}: {f['reason']}"
+            by_reason[key] = by_reason.get(key, 0) + 1
+        return dict(
+            stages=stages,
+            counts=dict(self.counts),
+            failures=dict(by_reason=by_reason, limbs=self.failures),
+        )
+
+    def report(self):
+        """Human readable table of the summary."""
+        s = self.summary()
+        lines = [f"{'stage':<22}{'calls':>8}{'total s':>10}{'mean us':>10}{'p50 us':>10}{'p99 us':>10}"]
+        for name, st in s["stages"].items():
+            lines.append(
+                f"{name:<22}{st['calls']:>8}{st['total_s']:>10.3f}"
+                f"{st['mean_us']:>10.1f}{st['p50_us']:>10.1f}{st['p99_us']:>10.1f}"
+            )
+        for name, n in s["counts"].items():
+            lines.append(f"{name:<22}{n:>8}")
+        for reason, n in s["failures"]["by_reason"].items():
+            lines.append(f"failed at {reason:<12}{n:>8}")
+        return "\n".join(lines)
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.summary(), f, indent=1)
+        return filename
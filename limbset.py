@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact binary container for collections of limbs, opened with np.memmap.
+
+File layout (all little-endian, sections aligned to 64 bytes):
+
+    offset  size  content
+    0       8     magic b"WLIMBSET"
+    8       4     uint32 format version (1)
+    12      4     reserved
+    16      8     uint64 n_limbs
+    24      8     uint64 n_points (total number of points)
+    32      8     uint64 byte offset of the points section
+    40      8     uint64 byte offset of the offsets section
+    48      8     uint64 byte offset of the metadata section
+    56      8     reserved
+
+    points    float32 (n_points, 2)  x, y of all limbs one after the other
+    offsets   int64   (n_limbs + 1)  points of limb i are points[offsets[i]:offsets[i+1]]
+    metadata  LIMBSET_META_DTYPE (n_limbs)  fixed-width columns, see below
+
+Points are stored as Limb.datapoints, i.e. already scaled and mirrored for
+left limbs. Single precision gives about 1e-4 px resolution on images a few
+thousand pixels wide.
+
+Usage:
+    python limbset.py data/staged_welsh/ staged_welsh.limbset
+"""
+import os
+import sys
+import numpy as np
+from utils import Limb
+
+MAGIC = b"WLIMBSET"
+VERSION = 1
+_HEADER_DTYPE = np.dtype(
+    [
+        ("magic", "S8"),
+        ("version", "<u4"),
+        ("reserved", "<u4"),
+        ("n_limbs", "<u8"),
+        ("n_points", "<u8"),
+        ("points_offset", "<u8"),
+        ("offsets_offset", "<u8"),
+        ("meta_offset", "<u8"),
+        ("reserved2", "<u8"),
+    ]
+)
+LIMBSET_META_DTYPE = np.dtype(
+    [
+        ("name", "S64"),
+        ("side", "S1"),
+        ("author", "S15"),
+        ("day", "<i2"),
+        ("hour", "<i2"),
+        ("age", "<i4"),
+        ("litterID", "S16"),
+        ("embryoID", "S16"),
+    ]
+)
+
+
+def _align(n, a=64):
+    return (n + a - 1) // a * a
+
+
+#################################################################################
+def write_limbset(filename, limbs):
+    """Write a list of Limb objects to a binary limbset file."""
+    n_limbs = len(limbs)
+    counts = np.array([len(limb.datapoints) for limb in limbs], dtype="<i8")
+    offsets = np.r_[0, np.cumsum(counts)].astype("<i8")
+    n_points = int(offsets[-1])
+
+    meta = np.zeros(n_limbs, dtype=LIMBSET_META_DTYPE)
+    for i, limb in enumerate(limbs):
+        meta[i] = (
+            limb.name.encode()[:64],
+            limb.side.encode()[:1],
+            limb.author.encode()[:15],
+            limb.day,
+            limb.hour,
+            limb.age,
+            str(limb.litterID).encode()[:16],
+            str(limb.embryoID).encode()[:16],
+        )
+
+    header = np.zeros(1, dtype=_HEADER_DTYPE)
+    header["magic"] = MAGIC
+    header["version"] = VERSION
+    header["n_limbs"] = n_limbs
+    header["n_points"] = n_points
+    header["points_offset"] = _align(_HEADER_DTYPE.itemsize)
+    header["offsets_offset"] = _align(header["points_offset"][0] + n_points * 2 * 4)
+    header["meta_offset"] = _align(header["offsets_offset"][0] + offsets.nbytes)
+
+    points = [np.asarray(limb.datapoints, dtype="<f4").reshape(-1, 3)[:, :2] for limb in limbs]
+    with open(filename, "wb") as f:
+        f.write(header.tobytes())
+        for section, data in (
+            ("points_offset", points),
+            ("offsets_offset", [offsets]),
+            ("meta_offset", [meta]),
+        ):
+            f.write(b"\0" * (int(header[section][0]) - f.tell()))
+            for d in data:
+                f.write(np.ascontiguousarray(d).tobytes())
+    return filename
+
+
+def convert_txt_dir(source, filename, author="welsh"):
+    """Convert a directory of limb .txt files into a limbset file."""
+    names = sorted(fn for fn in os.listdir(source) if fn.endswith(".txt"))
+    limbs = [Limb(os.path.join(source, fn), author=author) for fn in names]
+    return write_limbset(filename, limbs)
+
+
+#################################################################################
+class LimbSet:
+    """Read-only view of a limbset file, memory-mapped.
+
+    Nothing is read until accessed: indexing gives a Limb object, slicing or
+    indexing with an array (e.g. a mask on meta) gives a new LimbSet view.
+    Columns can be read directly from the meta structured array,
+    e.g. limbset.meta["age"].
+    """
+
+    def __init__(self, filename, _view=None):
+        self.filename = filename
+        if _view is not None:
+            self.points, self.offsets, self.meta, self._ids = _view
+            return
+        header = np.fromfile(filename, dtype=_HEADER_DTYPE, count=1)[0]
+        if header["magic"] != MAGIC or header["version"] != VERSION:
+            raise ValueError(f"{filename} is not a limbset file (version {VERSION})")
+        n_limbs, n_points = int(header["n_limbs"]), int(header["n_points"])
+        self.points = np.memmap(
+            filename, dtype="<f4", mode="r", offset=int(header["points_offset"]), shape=(n_points, 2)
+        ) if n_points else np.zeros((0, 2), dtype="<f4")
+        self.offsets = np.memmap(
+            filename, dtype="<i8", mode="r", offset=int(header["offsets_offset"]), shape=(n_limbs + 1,)
+        )
+        self.meta = np.memmap(
+            filename, dtype=LIMBSET_META_DTYPE, mode="r", offset=int(header["meta_offset"]), shape=(n_limbs,)
+        ) if n_limbs else np.zeros(0, dtype=LIMBSET_META_DTYPE)
+        self._ids = None
+
+    def __len__(self):
+        return len(self.meta)
+
+    def _limb_id(self, i):
+        return i if self._ids is None else self._ids[i]
+
+    def datapoints(self, i):
+        """Points of limb i as a (n, 3) float64 array."""
+        j = self._limb_id(i)
+        xy = self.points[self.offsets[j] : self.offsets[j + 1]]
+        return np.c_[xy, np.zeros(len(xy))]
+
+    def limb(self, i):
+        """Limb i as a Limb object."""
+        m = self.meta[i]
+        limb = Limb(author=m["author"].decode())
+        limb.name = limb.filename = m["name"].decode()
+        limb.side = m["side"].decode()
+        limb.day, limb.hour, limb.age = int(m["day"]), int(m["hour"]), int(m["age"])
+        limb.litterID = m["litterID"].decode()
+        limb.embryoID = m["embryoID"].decode()
+        limb.datapoints = self.datapoints(i)
+        return limb
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError(key)
+            return self.limb(key)
+        ids = np.arange(len(self))[key]
+        if self._ids is not None:
+            ids = self._ids[ids]
+        view = (self.points, self.offsets, self.meta[key], ids)
+        return LimbSet(self.filename, _view=view)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.limb(i)
+
+
+#################################################################################
+if __name__ == "__main__":
+
+    if len(sys.argv) != 3:
+        print("Usage: python limbset.py <directory of txt files> <output.limbset>")
+        sys.exit(0)
+    outf = convert_txt_dir(sys.argv[1], sys.argv[2])
+    print(f"{len(LimbSet(outf))} limbs written to {outf}")
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pure numpy/scipy implementation of the limb shape descriptors.
+
+It reproduces the pipeline of stager.descriptors() without allocating any
+VTK object: B-spline resampling (same as vedo.Spline), centre of mass distance
+profile, three rounds of circle fitting (same as vedo.fit_circle) and
+peak/valley detection, ruled-surface area between peaks and valleys
+(same as vedo.Ribbon with mode=0, res=(200,5)) and parabolic fit of the valleys.
+
+Results agree with the VTK-based implementation to about 1e-5 (relative,
+absolute for a parabolic descriptor close to 0): VTK stores the ribbon
+points in single precision. Where a circle would be fitted to fewer than
+3 non-collinear peaks vedo.fit_circle returns an arbitrary circle or none,
+here the limb has no solution.
+"""
+import numpy as np
+from scipy.interpolate import splprep, splev
+from utils import extrema_rows, fit_parabola
+from instrument import current
+
+# bump this whenever a change in this module alters the descriptor values,
+# cached descriptors computed by a different version are discarded
+DESCRIPTOR_VERSION = "4"
+
+_ROUNDS = ("round 1", "round 2", "round 3")
+_BATCH_ROUNDS = ("batch round 1", "batch round 2", "batch round 3")
+_COLLINEAR_TOL = 1e-10  # relative, below it the points of a circle fit are on a line
+
+
+#################################################################################
+def resample_outline(datapoints, res=200, smooth=0.0, degree=2):
+    """Resample the outline with a B-spline through the points (as vedo.Spline)."""
+    points = np.asarray(datapoints, dtype=float)
+    if points.shape[1] == 2:
+        points = np.c_[points, np.zeros(len(points))]
+    if smooth:
+        maxb = np.max(points.max(axis=0) - points.min(axis=0))
+        smooth *= maxb / 2  # must be in absolute units
+    tckp, _ = splprep(points.T, task=0, s=smooth, k=degree)
+    xnew, ynew, znew = splev(np.linspace(0.0, 1.0, res), tckp)
+    return np.c_[xnew, ynew, znew]
+
+
+def fit_circle_2d(points):
+    """Fit a circle to a set of points lying on the xy plane (as vedo.fit_circle).
+    Returns the center and the radius, which is 0 if the fit is degenerate
+    (fewer than 3 points, or all of them on a line)."""
+    data = np.asarray(points, dtype=float)
+    offs = data.mean(axis=0)
+    xi = data[:, 0] - offs[0]
+    yi = data[:, 1] - offs[1]
+
+    x, y = xi.sum(), yi.sum()
+    xx, yy, xy = (xi * xi).sum(), (yi * yi).sum(), (xi * yi).sum()
+    xxx, yyy = (xi ** 3).sum(), (yi ** 3).sum()
+    xyy, xxy = (xi * yi * yi).sum(), (xi * xi * yi).sum()
+
+    N = len(xi)
+    k = (xx + yy) / N
+    a1 = xx - x * x / N
+    b1 = xy - x * y / N
+    c1 = 0.5 * (xxx + xyy - x * k)
+    a2 = xy - x * y / N
+    b2 = yy - y * y / N
+    c2 = 0.5 * (xxy + yyy - y * k)
+
+    d = a2 * b1 - a1 * b2
+    # d = -N^2 det(covariance) is only rounding noise for collinear points
+    if N < 3 or abs(d) <= _COLLINEAR_TOL * a1 * b2:
+        return offs, 0
+    x0 = (b1 * c2 - b2 * c1) / d
+    y0 = (c1 - a1 * x0) / b1
+    with np.errstate(invalid="ignore"):
+        R = np.sqrt(x0 * x0 + y0 * y0 - 1 / N * (2 * x0 * x + 2 * y0 * y - xx - yy))
+    center = offs.copy()
+    center[0] += x0
+    center[1] += y0
+    return center, R
+
+
+def _resample_polyline(line, n):
+    # n points evenly spaced by arc length along a 2D polyline
+    seglen = np.sqrt((np.diff(line, axis=0) ** 2).sum(axis=1))
+    cumlen = np.r_[0, np.cumsum(seglen)]
+    s = np.linspace(0, cumlen[-1], n)
+    return np.c_[np.interp(s, cumlen, line[:, 0]), np.interp(s, cumlen, line[:, 1])]
+
+
+def ruled_surface(line1, line2, res=(200, 5)):
+    """Points of the ruled surface joining two 2D polylines (as vedo.Ribbon).
+
+    Both lines are resampled by arc length into res[0]+1 points and each pair
+    is joined by res[1]+1 points. Returns an array of shape (res[0]+1, res[1]+1, 2).
+    """
+    l1 = _resample_polyline(np.asarray(line1, dtype=float)[:, :2], res[0] + 1)
+    l2 = _resample_polyline(np.asarray(line2, dtype=float)[:, :2], res[0] + 1)
+    t = np.linspace(0, 1, res[1] + 1)[None, :, None]
+    return l1[:, None, :] + t * (l2 - l1)[:, None, :]
+
+
+def ribbon_area(grid):
+    """Area of a ruled surface grid, every quad is split into two triangles
+    along the same diagonal used by vtkRuledSurfaceFilter."""
+    p00 = grid[:-1, :-1]
+    p10 = grid[1:, :-1]
+    p01 = grid[:-1, 1:]
+    p11 = grid[1:, 1:]
+
+    def tri_area(a, b, c):
+        u, v = b - a, c - a
+        return 0.5 * np.abs(u[..., 0] * v[..., 1] - u[..., 1] * v[..., 0])
+
+    return tri_area(p00, p10, p01).sum() + tri_area(p01, p10, p11).sum()
+
+
+def _extrema(data_y):
+    # the 5 largest peaks and 6 valleys of a profile, indices and [index, value] arrays
+    pid, pmask, vid, vmask = extrema_rows(data_y[None], 5, 6)
+    peak_x, valley_x = pid[0][pmask[0]], vid[0][vmask[0]]
+    return peak_x, np.c_[peak_x, data_y[peak_x]], valley_x, np.c_[valley_x, data_y[valley_x]]
+
+
+#################################################################################
+def shape_descriptors(datapoints, res=200, details=False):
+    """Compute the area, aspect ratio and parabolic descriptors of a limb outline.
+
+    Returns the array [area, aratio, parabolic]*10 (all zeros if no solution
+    can be found). If details is True also return a dict with the intermediate
+    quantities needed to visualize the result (empty if no solution).
+    """
+    failed = (np.zeros(3), {}) if details else np.zeros(3)
+    ins = current()
+
+    with ins.timer("resample"):
+        epts = resample_outline(datapoints, res=res)
+        cm1 = epts.mean(axis=0)
+        size = np.mean(np.linalg.norm(epts - cm1, axis=1))  # as eline.average_size()
+        epts /= size
+
+    ## three rounds: the first from the centre of mass, then from the circle through the peaks ##
+    cm = epts.mean(axis=0)
+    cms = []
+    for rnd in _ROUNDS:
+        with ins.timer(rnd):
+            if cms:
+                cm, r = fit_circle_2d(epts[peak_x])
+                if not r:
+                    ins.fail(rnd, "zero radius")
+                    return failed
+            cms.append(cm)
+            data_y = np.linalg.norm(epts - cm, axis=1)
+            peak_x, green_peaks, valley_x, red_valleys = _extrema(data_y)
+        if len(peak_x) == 0 or len(valley_x) == 0:
+            ins.fail(rnd, "no peaks" if len(peak_x) == 0 else "no valleys")
+            return failed
+    r3 = r
+
+    with ins.timer("ribbon"):
+        grid = ruled_surface(green_peaks, red_valleys)
+        area = ribbon_area(grid) / r3 / 10
+        xb = grid[..., 0].min(), grid[..., 0].max()
+        yb = grid[..., 1].min(), grid[..., 1].max()
+        aratio = 1000 * (yb[1] - yb[0]) / (xb[1] - xb[0]) / r3
+
+    with ins.timer("parabola"):
+        fitpar, parabolapts = fit_parabola(valley_x, red_valleys[:, 1])
+    parabolic = 2e04 * fitpar[0] + 1
+
+    result = np.array([area, aratio, parabolic]) * 10
+    if not details:
+        return result
+    info = dict(
+        epts=epts,
+        size=size,
+        data_y=data_y,
+        cms=cms,
+        r3=r3,
+        peak_x=peak_x,
+        valley_x=valley_x,
+        green_peaks=green_peaks,
+        red_valleys=red_valleys,
+        parabolapts=parabolapts,
+    )
+    return result, info
+
+
+#################################################################################
+# Batched version: all limbs are resampled into one (N, res, 3) array and the
+# three rounds are computed with array operations across limbs.
+# Limbs for which no solution is found get (0, 0, 0), as in shape_descriptors().
+#################################################################################
+def resample_outlines(datapoints_list, res=200):
+    """Resample a list of outlines into one contiguous (N, res, 3) array.
+    Also returns a boolean mask of the outlines that could be resampled."""
+    outlines = np.zeros((len(datapoints_list), res, 3))
+    ok = np.zeros(len(datapoints_list), dtype=bool)
+    for i, datapoints in enumerate(datapoints_list):
+        if len(datapoints) <= 2:
+            continue
+        try:
+            outlines[i] = resample_outline(datapoints, res=res)
+            ok[i] = True
+        except (ValueError, TypeError, IndexError):
+            pass  # e.g. duplicated or too few points for the spline
+    return outlines, ok
+
+
+def _pad_last(ids, mask):
+    # replace invalid trailing entries with the last valid one
+    last = np.maximum(mask.sum(axis=1) - 1, 0)
+    pos = np.minimum(np.arange(ids.shape[1])[None, :], last[:, None])
+    return np.take_along_axis(ids, pos, axis=1)
+
+
+def fit_circles_2d(points, mask):
+    """Vectorized fit_circle_2d() for (N, k, 2+) points, with an (N, k) validity mask.
+    Returns the (N, 2) centers and the (N,) radii (0 for degenerate fits)."""
+    w = mask.astype(float)
+    N = w.sum(axis=1)
+    Ns = np.maximum(N, 1)
+    offs = (points[..., :2] * w[..., None]).sum(axis=1) / Ns[:, None]
+    xi = (points[..., 0] - offs[:, 0:1]) * w
+    yi = (points[..., 1] - offs[:, 1:2]) * w
+
+    x, y = xi.sum(axis=1), yi.sum(axis=1)
+    xx, yy, xy = (xi * xi).sum(axis=1), (yi * yi).sum(axis=1), (xi * yi).sum(axis=1)
+    xxx, yyy = (xi ** 3).sum(axis=1), (yi ** 3).sum(axis=1)
+    xyy, xxy = (xi * yi * yi).sum(axis=1), (xi * xi * yi).sum(axis=1)
+
+    k = (xx + yy) / Ns
+    a1 = xx - x * x / Ns
+    b1 = xy - x * y / Ns
+    c1 = 0.5 * (xxx + xyy - x * k)
+    a2 = xy - x * y / Ns
+    b2 = yy - y * y / Ns
+    c2 = 0.5 * (xxy + yyy - y * k)
+
+    d = a2 * b1 - a1 * b2
+    good = (N >= 3) & (np.abs(d) > _COLLINEAR_TOL * a1 * b2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x0 = np.where(good, (b1 * c2 - b2 * c1) / np.where(good, d, 1), 0)
+        y0 = np.where(good, (c1 - a1 * x0) / np.where(b1 != 0, b1, np.nan), 0)
+        R = np.sqrt(x0 * x0 + y0 * y0 - 1 / Ns * (2 * x0 * x + 2 * y0 * y - xx - yy))
+    R = np.where(good, R, 0)
+    return offs + np.c_[x0, y0], R
+
+
+def _resample_polylines(lines, n):
+    # vectorized _resample_polyline() for (N, k, 2) polylines
+    seglen = np.sqrt((np.diff(lines, axis=1) ** 2).sum(axis=2))
+    cumlen = np.concatenate([np.zeros((len(lines), 1)), np.cumsum(seglen, axis=1)], axis=1)
+    s = np.linspace(0, 1, n)[None, :] * cumlen[:, -1:]
+    seg = (s[:, :, None] >= cumlen[:, None, :]).sum(axis=2) - 1
+    seg = np.clip(seg, 0, lines.shape[1] - 2)
+    c0 = np.take_along_axis(cumlen, seg, axis=1)
+    sl = np.take_along_axis(seglen, seg, axis=1)
+    t = np.divide(s - c0, sl, out=np.zeros_like(s), where=sl > 0)
+    p0 = np.take_along_axis(lines, seg[..., None], axis=1)
+    p1 = np.take_along_axis(lines, seg[..., None] + 1, axis=1)
+    return p0 + t[..., None] * (p1 - p0)
+
+
+def _polyfit2(x, y, mask):
+    # vectorized np.polyfit(x, y, 2) over rows, ignoring masked-out entries
+    w = mask.astype(float)
+    V = np.stack([x * x, x, np.ones_like(x)], axis=2) * w[..., None]
+    scale = np.sqrt((V * V).sum(axis=1))
+    scale[scale == 0] = 1
+    coef = np.einsum("nij,nj->ni", np.linalg.pinv(V / scale[:, None, :]), y * w)
+    return coef / scale
+
+
+def _tri_areas(a, b, c):
+    # total area of the triangles (a, b, c) of each (N, ...) grid
+    u, v = b - a, c - a
+    return 0.5 * np.abs(u[..., 0] * v[..., 1] - u[..., 1] * v[..., 0]).sum(axis=(1, 2))
+
+
+def _record_failures(ins, newly_failed, ids, stage, reason):
+    for j in ids[newly_failed]:
+        ins.fail(stage, reason, limb=int(j))
+
+
+def descriptors_from_outlines(outlines, ok=None, first=0, n_peaks=5, n_valleys=6, distance=20):
+    """Compute [area, aratio, parabolic]*10 for a stacked (N, res, 3) array of
+    resampled outlines. Returns an (N, 3) array, rows of zeros where no solution
+    is found (or where ok is False). Failures are reported to an active
+    Instrument with limb indices starting at first.
+    n_peaks, n_valleys and distance are passed to extrema_rows()."""
+    ins = current()
+    outlines = np.asarray(outlines, dtype=float)
+    nlimbs = len(outlines)
+    ok = np.ones(nlimbs, dtype=bool) if ok is None else np.array(ok, dtype=bool)
+    results = np.zeros((nlimbs, 3))
+    if not ok.any():
+        return results
+
+    epts = outlines[ok, :, :2]
+    cm = epts.mean(axis=1, keepdims=True)
+    epts = epts / np.linalg.norm(epts - cm, axis=2).mean(axis=1)[:, None, None]
+    cm = epts.mean(axis=1)
+    good = np.ones(len(epts), dtype=bool)
+    ids = np.flatnonzero(ok) + first
+
+    for rnd, name in enumerate(_BATCH_ROUNDS):
+        with ins.timer(name):
+            if rnd:
+                cm, r = fit_circles_2d(np.take_along_axis(epts, peak_x[..., None], axis=1), pmask)
+                if ins:
+                    _record_failures(ins, good & (r == 0), ids, _ROUNDS[rnd], "zero radius")
+                good &= r != 0
+            data_y = np.linalg.norm(epts - cm[:, None, :], axis=2)
+            peak_x, pmask, valley_x, vmask = extrema_rows(data_y, n_peaks, n_valleys, distance)
+            if ins:
+                no_peaks = good & ~pmask.any(axis=1)
+                _record_failures(ins, no_peaks, ids, _ROUNDS[rnd], "no peaks")
+                _record_failures(ins, good & ~no_peaks & ~vmask.any(axis=1), ids, _ROUNDS[rnd], "no valleys")
+            good &= pmask.any(axis=1) & vmask.any(axis=1)
+            peak_x = _pad_last(peak_x, pmask)
+            valley_x = _pad_last(valley_x, vmask)
+    r3 = np.where(good, r, 1)
+
+    with ins.timer("batch ribbon"):
+        green_peaks = np.stack([peak_x, np.take_along_axis(data_y, peak_x, axis=1)], axis=2)
+        red_valleys = np.stack([valley_x, np.take_along_axis(data_y, valley_x, axis=1)], axis=2)
+        l1 = _resample_polylines(green_peaks, 201)
+        l2 = _resample_polylines(red_valleys, 201)
+        t = np.linspace(0, 1, 6)[None, None, :, None]
+        grid = l1[:, :, None, :] + t * (l2 - l1)[:, :, None, :]  # (N, 201, 6, 2)
+
+        p00, p10 = grid[:, :-1, :-1], grid[:, 1:, :-1]
+        p01, p11 = grid[:, :-1, 1:], grid[:, 1:, 1:]
+        area = (_tri_areas(p00, p10, p01) + _tri_areas(p01, p10, p11)) / r3 / 10
+        xb = grid[..., 0].min(axis=(1, 2)), grid[..., 0].max(axis=(1, 2))
+        yb = grid[..., 1].min(axis=(1, 2)), grid[..., 1].max(axis=(1, 2))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            aratio = 1000 * (yb[1] - yb[0]) / (xb[1] - xb[0]) / r3
+
+    with ins.timer("batch parabola"):
+        fitpar = _polyfit2(valley_x.astype(float), red_valleys[..., 1], vmask)
+        parabolic = 2e04 * fitpar[:, 0] + 1
+
+    res = np.c_[area, aratio, parabolic] * 10
+    res[~good] = 0
+    results[ok] = res
+    return results
+
+
+def descriptors_batch(datapoints_list, res=200, chunk=1024, **extrema):
+    """Compute the shape descriptors of many limbs at once.
+
+    Outlines are resampled into one contiguous (N, res, 3) array and processed
+    in chunks of limbs with array operations. Returns an (N, 3) array of
+    [area, aratio, parabolic]*10, with rows of zeros for failed limbs.
+    Keyword arguments (n_peaks, n_valleys, distance) go to descriptors_from_outlines().
+    """
+    ins = current()
+    results = np.zeros((len(datapoints_list), 3))
+    for i in range(0, len(datapoints_list), chunk):
+        with ins.timer("batch resample"):
+            outlines, ok = resample_outlines(datapoints_list[i : i + chunk], res=res)
+        if ins:
+            _record_failures(ins, ~ok, np.arange(len(ok)) + i, "resample", "spline failed")
+        results[i : i + chunk] = descriptors_from_outlines(outlines, ok, first=i, **extrema)
+    return results
+
+
+#################################################################################
+def outline_descriptors(datapoints, presample=False):
+    """Descriptors of one outline, (0, 0, 0) instead of raising on bad input.
+    With presample=True the outline is first resampled to 200 points, as done
+    by the calibration routines. Top-level function, so usable by parallel_map()."""
+    try:
+        if presample:
+            datapoints = resample_outline(datapoints, res=200)
+        return shape_descriptors(datapoints)
+    except (ValueError, TypeError, IndexError) as e:
+        current().fail("error", f"{type(e).__name__}: {e}")
+        return np.zeros(3)
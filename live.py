@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Live staging while the outline is clicked on the image.
+
+LiveSplinePlotter is the SplinePlotter of stager.py that, after every added
+or removed point, recomputes the descriptors and the calibration lookup of
+the current outline and updates the age/chi2 readout and the peak (green)
+and valley (red) markers, so that a bad outline can be fixed before pressing q.
+
+To stay within one frame (~16 ms) per click: the calibration is loaded and
+its KD-tree built before the window opens, the descriptors are computed with
+limbshape.shape_descriptors() without building any plotting object, and the
+markers are fixed-size point clouds whose coordinates are updated in place.
+
+    python stager.py pics/E14.5_L3-03_HL2.5X.jpg --live
+
+Running this file replays the points of a txt file off-screen, one click at
+a time, checks that the readout follows them and prints the update times:
+
+    python live.py pics/E14.5_L3-03_HL2.5X.jpg pics/E14.5_L3-03_HL2.5X_LHL.txt
+"""
+import time
+import argparse
+import numpy as np
+from vedo import Points, Text2D
+from vedo.applications import SplinePlotter
+from calibration import get_calibration
+from limbshape import shape_descriptors
+from utils import age_as_string
+
+_NPEAKS, _NVALLEYS = 5, 6  # as in limbshape._extrema()
+
+
+class LiveSplinePlotter(SplinePlotter):
+    """SplinePlotter showing the staging of the clicked outline as it changes."""
+
+    def __init__(self, obj, calibration=None, **kwargs):
+        super().__init__(obj, **kwargs)
+        self.calibration = calibration or get_calibration()
+        self.calibration.lookup_many(np.zeros((1, 3)))  # load and build the index now
+        self.latency = 0.0  # seconds of the last update, without rendering
+
+        self._peaks = Points(np.zeros((_NPEAKS, 3)), r=14, c="green5").pickable(False)
+        self._valleys = Points(np.zeros((_NVALLEYS, 3)), r=14, c="red5").pickable(False)
+        self._peaks.off()
+        self._valleys.off()
+        self._readout = Text2D("", pos="top-left", c="k1", bg="y9", alpha=0.7, font="Calco")
+        self.add(self._peaks, self._valleys, self._readout)
+
+    def _update(self):  # called by the SplinePlotter of vedo < 2025
+        super()._update()
+        self.update_staging()
+
+    def update(self):  # renamed from _update() in later vedo versions
+        super().update()
+        self.update_staging()
+
+    def _key_press(self, evt):
+        super()._key_press(evt)
+        if evt.keypress == "c":
+            self.update_staging()
+
+    @staticmethod
+    def _set_markers(markers, points, n):
+        # update the coordinates in place, missing ones are put on the last one
+        pts = np.empty((n, 3))
+        pts[: len(points)] = points
+        pts[len(points) :] = points[-1]
+        pts[:, 2] = 1  # above the image
+        markers.vertices = pts
+        markers.on()
+
+    def stage_points(self):
+        """Descriptors, age, sigma, chi2 and the peaks and valleys (as image points)
+        of the clicked outline, None if it cannot be staged."""
+        if len(self.cpoints) <= 5:
+            return None
+        try:
+            result, info = shape_descriptors(np.asarray(self.cpoints, dtype=float), details=True)
+        except (ValueError, TypeError, IndexError):
+            return None  # e.g. duplicated points
+        if not info:
+            return None
+        _, _, age, sigma, chi2 = self.calibration.lookup(result)
+        epts = info["epts"] * info["size"]
+        return result, age, sigma, chi2, epts[info["peak_x"]], epts[info["valley_x"]]
+
+    def update_staging(self):
+        """Recompute the staging of the clicked points and update readout and markers."""
+        t0 = time.perf_counter()
+        staged = self.stage_points()
+        if staged is None:
+            self._peaks.off()
+            self._valleys.off()
+            msg = "click more points" if len(self.cpoints) <= 5 else "no solution for this outline"
+        else:
+            _, age, sigma, chi2, peaks, valleys = staged
+            self._set_markers(self._peaks, peaks, _NPEAKS)
+            self._set_markers(self._valleys, valleys, _NVALLEYS)
+            msg = f"{age_as_string(age)} :pm{sigma}h  ({age}h)   chi2 = {chi2:.2f}"
+        self.latency = time.perf_counter() - t0
+        self._readout.text(f"{msg}\n{len(self.cpoints)} points, {1000 * self.latency:.1f} ms")
+        self.render()
+
+
+#################################################################################
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="welsh_stager live staging check")
+    parser.add_argument("image", help="image shown while clicking")
+    parser.add_argument("points", help="txt file with the MEASURED points to replay")
+    args = parser.parse_args()
+
+    from vedo import Image
+    from utils import read_measured_points
+
+    datapoints = read_measured_points(args.points)
+    plt = LiveSplinePlotter(Image(args.image, channels=(0, 1, 2)), offscreen=True)
+    plt.verbose = False
+    readouts, latencies = [], []
+    for p in datapoints:  # as if clicked one by one
+        plt.points(list(plt.cpoints) + [p])
+        readouts.append(plt._readout.text())
+        latencies.append(plt.latency)
+    plt.close()
+
+    if len(set(readouts)) < 2 or "click more points" in readouts[-1]:
+        print(f"ERROR: the readout did not follow the clicks, last one: {readouts[-1]!r}")
+        exit(1)
+    print(readouts[-1])
+    print(f"{len(datapoints)} clicks, update time median {1000 * np.median(latencies):.1f} ms,"
+          f" max {1000 * np.max(latencies):.1f} ms")
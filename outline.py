@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Automatic extraction of the limb outline from a picture.
+
+The limb is segmented by thresholding a smoothed channel of the image
+(Otsu threshold, on one or two levels, largest region kept) or by growing
+a region of similar colour from a seed point inside the limb. The mask is
+cleaned with a morphological opening/closing and its holes are filled.
+Its boundary is traced, the part lying on the image frame is dropped (the
+limb is cut by the frame at the wrist) and the open curve is resampled to a
+fixed number of points, in the same coordinates as the points clicked in
+the stager window (pixels, y up).
+
+Segmentation is only as good as the contrast of the picture: check the
+outline with `python stager.py image.jpg --auto`, which opens the clicking
+window with the extracted points so that they can be corrected.
+
+Usage:
+    python outline.py pics/ --outdir output -o results.csv
+    python outline.py pics/E14.5_L3-03_HL2.5X.jpg --seed 760 470 --tolerance 35
+"""
+import os
+import argparse
+from glob import glob
+import numpy as np
+from scipy import ndimage
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp")
+
+# 8-neighbours clockwise starting from north, as (row, column) offsets
+_MOORE = ((-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1))
+
+
+#################################################################################
+def read_image(filename):
+    """Image as a float array of shape (rows, columns, 3), first row on top."""
+    from PIL import Image  # installed with vedo
+
+    with Image.open(filename) as im:
+        return np.asarray(im.convert("RGB"), dtype=float)
+
+
+def otsu_threshold(values, bins=256):
+    """Threshold maximizing the variance between the two classes of values."""
+    hist, edges = np.histogram(values, bins=bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    w0 = np.cumsum(hist)
+    w1 = w0[-1] - w0
+    m = np.cumsum(hist * centers)
+    mu0 = m / np.maximum(w0, 1)
+    mu1 = (m[-1] - m) / np.maximum(w1, 1)
+    return centers[np.argmax(w0 * w1 * (mu0 - mu1) ** 2)]
+
+
+def segment_limb(rgb, channel=1, levels=1, smooth=3.0, seed=None, tolerance=None, clean=5):
+    """Boolean mask of the limb (rows, columns).
+
+    Without a seed, a colour channel is thresholded (the green one separates
+    best the pale tissue from a red or dark background, "gray" uses the mean
+    of the channels) and the largest region is kept. With levels=2 the Otsu
+    threshold is computed again on the bright side, to leave out other
+    bright tissue around the limb.
+    With a seed, an (x, y) point inside the limb in image coordinates (y up),
+    the region is grown from it over the pixels whose colour differs less
+    than tolerance from the colour around the seed (Otsu threshold of the
+    colour distance if tolerance is not given)."""
+    if seed is not None:
+        smoothed = np.stack([ndimage.gaussian_filter(rgb[..., k], smooth) for k in range(3)], axis=-1)
+        col, row = int(round(seed[0])), len(rgb) - 1 - int(round(seed[1]))
+        if not (0 <= row < len(rgb) and 0 <= col < rgb.shape[1]):
+            print(f"Seed point {seed} is outside of the image")
+            return np.zeros(rgb.shape[:2], dtype=bool)
+        ref = smoothed[max(row - 10, 0): row + 11, max(col - 10, 0): col + 11].reshape(-1, 3).mean(axis=0)
+        dist = np.linalg.norm(smoothed - ref, axis=2)
+        mask = dist < (tolerance or otsu_threshold(dist))
+    else:
+        img = rgb.mean(axis=2) if channel == "gray" else rgb[..., int(channel)]
+        img = ndimage.gaussian_filter(img, smooth)
+        t = otsu_threshold(img)
+        for _ in range(levels - 1):
+            t = otsu_threshold(img[img > t])
+        mask = img > t
+    if clean:
+        mask = ndimage.binary_opening(mask, iterations=clean)
+        mask = ndimage.binary_closing(mask, iterations=clean, border_value=1)
+    mask = ndimage.binary_fill_holes(mask)
+
+    labels, n = ndimage.label(mask)
+    if not n:
+        return mask
+    if seed is not None:
+        keep = labels[row, col]
+        if not keep:
+            print(f"Seed point {seed} is outside of the segmented regions")
+            return np.zeros_like(mask)
+    else:
+        keep = np.argmax(np.bincount(labels.ravel())[1:]) + 1
+    return labels == keep
+
+
+def trace_boundary(mask):
+    """Ordered (row, column) pixels of the outer boundary of the region in mask
+    (Moore neighbour tracing, clockwise on screen)."""
+    m = np.pad(mask.astype(bool), 1)
+    found = np.argwhere(m)
+    if not len(found):
+        return np.zeros((0, 2), dtype=int)
+    r0, c0 = found[0]  # topmost, then leftmost pixel
+    r, c, d = r0, c0, 6  # pixels west of it are background
+    contour = [(r0, c0)]
+    first = None
+    for _ in range(4 * m.size):
+        for k in range(8):
+            dd = (d + k) % 8
+            if m[r + _MOORE[dd][0], c + _MOORE[dd][1]]:
+                break
+        else:
+            break  # isolated pixel
+        if first is None:
+            first = dd
+        elif (r, c) == (r0, c0) and dd == first:
+            contour.pop()  # back to the start
+            break
+        r, c = r + _MOORE[dd][0], c + _MOORE[dd][1]
+        contour.append((r, c))
+        d = (dd + 5) % 8  # sweep clockwise starting after the previous pixel
+    return np.array(contour, dtype=int) - 1
+
+
+def open_outline(contour, shape, margin=2):
+    """Drop the pixels of a closed contour that lie on the image frame and
+    return the longest remaining stretch. If the region does not touch the
+    frame the closed contour is returned starting from its lowest point."""
+    rows, cols = contour[:, 0], contour[:, 1]
+    onframe = (
+        (rows <= margin) | (cols <= margin)
+        | (rows >= shape[0] - 1 - margin) | (cols >= shape[1] - 1 - margin)
+    )
+    if not onframe.any():
+        return np.roll(contour, -np.argmax(rows), axis=0)
+    if onframe.all():
+        return contour[:0]
+    # start right after a stretch on the frame, then split in stretches
+    start = np.flatnonzero(onframe & ~np.roll(onframe, -1))[0] + 1
+    contour = np.roll(contour, -start, axis=0)
+    onframe = np.roll(onframe, -start)
+    edges = np.flatnonzero(np.diff(np.r_[1, onframe.astype(int), 1]))
+    runs = edges.reshape(-1, 2)  # [begin, end) of the stretches off the frame
+    b, e = runs[np.argmax(runs[:, 1] - runs[:, 0])]
+    return contour[b:e]
+
+
+def resample_curve(points, npoints, smooth=2.0):
+    """Gaussian smoothing and resampling at equal arc length of an open curve."""
+    points = ndimage.gaussian_filter1d(points.astype(float), smooth, axis=0, mode="nearest")
+    seglen = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    s = np.r_[0, np.cumsum(seglen)]
+    t = np.linspace(0, s[-1], npoints)
+    return np.c_[np.interp(t, s, points[:, 0]), np.interp(t, s, points[:, 1])]
+
+
+def extract_outline(image, npoints=90, channel=1, levels=1, smooth=3.0, seed=None, tolerance=None,
+                    min_length=100):
+    """Outline of the limb in an image file (or RGB array) as a (npoints, 3) array
+    in stager window coordinates: x to the right, y up, in pixels.
+    Returns an empty array if no outline longer than min_length pixels is found."""
+    rgb = read_image(image) if isinstance(image, str) else np.asarray(image, dtype=float)
+    mask = segment_limb(rgb, channel, levels, smooth, seed, tolerance)
+    curve = open_outline(trace_boundary(mask), mask.shape)
+    if len(curve) < min_length:
+        return np.zeros((0, 3))
+    rc = resample_curve(curve, npoints)
+    return np.c_[rc[:, 1], len(mask) - 1 - rc[:, 0], np.zeros(npoints)]
+
+
+#################################################################################
+def collect_images(sources):
+    """Expand directories and glob patterns into a sorted list of image files."""
+    filenames = []
+    for src in sources:
+        if os.path.isdir(src):
+            filenames += glob(os.path.join(src, "*"))
+        elif os.path.isfile(src):
+            filenames.append(src)
+        else:
+            filenames += glob(src)
+    return sorted(set(f for f in filenames if f.lower().endswith(IMAGE_EXTENSIONS)))
+
+
+def extract_outlines(filenames, outdir="output", verbose=True, **kwargs):
+    """Extract the outline of every image and write it as <outdir>/<image>.txt
+    with MEASURED points. Returns the list of written files."""
+    from stager import write_measured_points
+
+    os.makedirs(outdir, exist_ok=True)
+    written = []
+    for filename in filenames:
+        try:
+            pts = extract_outline(filename, **kwargs)
+        except OSError as e:
+            print(f"{filename}: cannot read image ({e})")
+            continue
+        if not len(pts):
+            print(f"{filename}: no outline found")
+            continue
+        basename = os.path.splitext(os.path.basename(filename))[0]
+        written.append(write_measured_points(os.path.join(outdir, basename + ".txt"), pts))
+        if verbose:
+            print(f"{filename}: {len(pts)} points -> {written[-1]}")
+    return written
+
+
+#################################################################################
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="welsh_stager automatic outline extraction")
+    parser.add_argument("inputs", nargs="+", help="image files, directories or globs")
+    parser.add_argument("--outdir", default="output", help="where to write the txt files of points")
+    parser.add_argument("-o", "--output", default="", help="write the staging results to this .csv file")
+    parser.add_argument("--npoints", type=int, default=90, help="number of points of the outline")
+    parser.add_argument("--channel", default="1", help="colour channel to threshold: 0, 1, 2 or gray")
+    parser.add_argument("--levels", type=int, default=1, help="levels of Otsu thresholding")
+    parser.add_argument("--smooth", type=float, default=3.0, help="gaussian smoothing of the image")
+    parser.add_argument("--seed", type=float, nargs=2, default=None,
+                        help="x y of a point inside the limb (y up), grow the region from there")
+    parser.add_argument("--tolerance", type=float, default=None,
+                        help="with --seed: maximum colour difference from the seed (default: automatic)")
+    parser.add_argument("--no-staging", action="store_true", help="only write the txt files")
+    args = parser.parse_args()
+
+    images = collect_images(args.inputs)
+    if not images:
+        print("\nNo images found.\n")
+        exit(0)
+    channel = args.channel if args.channel == "gray" else int(args.channel)
+    txtfiles = extract_outlines(
+        images, args.outdir, npoints=args.npoints, channel=channel,
+        levels=args.levels, smooth=args.smooth, seed=args.seed, tolerance=args.tolerance,
+    )
+    if txtfiles and not args.no_staging:
+        from stager import stage_batch, write_table
+
+        rows = stage_batch(txtfiles)
+        if args.output:
+            write_table(rows, args.output)
+        else:
+            for row in rows:
+                print(f"{row['name']}  {row['age_string']} :pm{row['sigma']}h"
+                      f"  ({row['age']}h)  chi2={row['chi2']:.3g}  {row['status']}")
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Multiresolution loading of large microscope images.
+
+Level k of the pyramid is the image reduced 2**k times. Only the level shown
+in the window is decoded: JPEG files are decoded directly at the reduced size
+(PIL draft mode, the full resolution image is never in memory), other formats
+are decoded and reduced. Levels are cached on disk as .npy files, keyed by
+path, size and modification time of the image, and memory-mapped when the
+same image is staged again; the least recently used files are removed when
+the cache exceeds CACHE_MAX_BYTES. Points clicked on a level are mapped back to
+full resolution pixels with to_full() before staging.
+
+    pyr = ImagePyramid("scan.jpg")
+    k = pyr.level_for(2048)
+    preview = pyr.level(k)       # (rows, columns, 3) uint8 array
+    points = pyr.to_full(clicked_points, k)
+"""
+import os
+import hashlib
+from contextlib import contextmanager
+import numpy as np
+from PIL import Image  # installed with vedo
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "welsh_stager")
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# stitched scans can exceed the default decompression bomb limit of PIL (about 90 Mpixels),
+# the limit is raised only while the pyramid opens its own image
+MAX_PIXELS = 1024 ** 3
+
+
+@contextmanager
+def _open(filename):
+    default = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+    try:
+        im = Image.open(filename)
+    finally:
+        Image.MAX_IMAGE_PIXELS = default
+    with im:
+        yield im
+
+
+def prune_cache(cachedir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+    """Remove the least recently used levels until the cache is at most max_bytes."""
+    try:
+        entries = [e for e in os.scandir(cachedir) if e.name.endswith(".npy") and e.is_file()]
+    except OSError:
+        return
+    entries = sorted(((e.stat().st_mtime, e.stat().st_size, e.path) for e in entries), reverse=True)
+    total = 0
+    for _, size, path in entries:  # most recently used first
+        total += size
+        if total > max_bytes:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class ImagePyramid:
+    """Lazily decoded, disk cached downsampled levels of an image.
+    Set cachedir to None to disable the disk cache."""
+
+    def __init__(self, filename, cachedir=CACHE_DIR):
+        self.filename = filename
+        self.cachedir = cachedir
+        with _open(filename) as im:
+            self.size = im.size  # (width, height), only the header is read
+        st = os.stat(filename)
+        key = f"{os.path.abspath(filename)}|{st.st_size}|{st.st_mtime_ns}"
+        self.key = hashlib.sha1(key.encode()).hexdigest()[:16]
+        self._levels = {}
+
+    def level_for(self, max_size=2048):
+        """Smallest level whose longest side is at most max_size pixels."""
+        k = 0
+        while max(self.level_size(k)) > max_size:
+            k += 1
+        return k
+
+    def level_size(self, k):
+        """(width, height) of level k."""
+        f = 2 ** k
+        return -(-self.size[0] // f), -(-self.size[1] // f)
+
+    def _cache_file(self, k):
+        return os.path.join(self.cachedir, f"{self.key}_level{k}.npy")
+
+    def _decode(self, k):
+        w, h = self.level_size(k)
+        with _open(self.filename) as im:
+            if k:
+                im.draft("RGB", (w, h))  # JPEG: decode at 1/2, 1/4 or 1/8 of the size
+            im = im.convert("RGB")
+            if im.size != (w, h):
+                im = im.resize((w, h), Image.BOX)
+            return np.asarray(im)
+
+    def level(self, k):
+        """Level k as a (rows, columns, 3) uint8 array, first row on top."""
+        if k in self._levels:
+            return self._levels[k]
+        cached = self.cachedir and k and self._cache_file(k)
+        if cached and os.path.isfile(cached):
+            arr = np.load(cached, mmap_mode="r")
+            try:
+                os.utime(cached)  # mark as recently used for prune_cache()
+            except OSError:
+                pass
+        else:
+            arr = self._decode(k)
+            if cached:  # level 0 is the image itself, not cached
+                try:
+                    os.makedirs(self.cachedir, exist_ok=True)
+                    tmp = cached + f".{os.getpid()}.tmp.npy"
+                    np.save(tmp, arr)
+                    os.replace(tmp, cached)
+                    prune_cache(self.cachedir)
+                except OSError as e:
+                    print(f"Could not cache the image pyramid in {self.cachedir}: {e}")
+        self._levels[k] = arr
+        return arr
+
+    def scale(self, k):
+        """Size of a pixel of level k in full resolution pixels, along x and y."""
+        w, h = self.level_size(k)
+        return self.size[0] / w, self.size[1] / h
+
+    def to_full(self, points, k):
+        """Map (x, y[, z]) points in pixel coordinates of level k to full resolution
+        (same convention as the stager window: pixel centers, y up)."""
+        pts = np.array(points, dtype=float)
+        if not len(pts):
+            return pts
+        sx, sy = self.scale(k)
+        pts[:, 0] = (pts[:, 0] + 0.5) * sx - 0.5
+        pts[:, 1] = (pts[:, 1] + 0.5) * sy - 0.5
+        return pts
+
+    def to_level(self, points, k):
+        """Inverse of to_full()."""
+        pts = np.array(points, dtype=float)
+        if not len(pts):
+            return pts
+        sx, sy = self.scale(k)
+        pts[:, 0] = (pts[:, 0] + 0.5) / sx - 0.5
+        pts[:, 1] = (pts[:, 1] + 0.5) / sy - 0.5
+        return pts
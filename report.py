@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Off-screen staging reports: the same 3-panel image produced by predict(),
+for many limbs, without a display and without waiting for a key press.
+
+One off-screen render window is created and reused: the calibration panel
+is built once per calibration (see stager.calibration_panel) and only the
+embryo point, line, sphere and chi2 are moved for each limb, the other
+actors of each limb are replaced. On a Linux box without an X server use a VTK build with
+EGL or OSMesa support (e.g. the vtk-osmesa wheel) or run under xvfb-run.
+
+Usage:
+    python report.py data/litter_01/ "data/archive/*_LHL.txt" --outdir output
+"""
+import os
+import argparse
+from calibration import get_calibration
+from utils import read_limb_files
+from stager import (
+    descriptors,
+    collect_inputs,
+    calibration_panel,
+    embryo_texts,
+    version_text,
+    write_staging_outputs,
+    CALIBRATION_CAMERA,
+)
+
+
+#################################################################################
+class ReportRenderer:
+    """Render staging reports off-screen, reusing one Plotter across limbs.
+
+    Use as a context manager, or call close() at the end:
+        with ReportRenderer(outdir="output") as renderer:
+            for name, points in limbs:
+                renderer.render(points, name)
+    """
+
+    def __init__(self, calibration=None, outdir="output", size=(1800, 1000), offscreen=True):
+        from vedo import Plotter
+
+        self.calibration = calibration or get_calibration()
+        self.outdir = outdir
+        os.makedirs(outdir, exist_ok=True)
+
+        self.plt = Plotter(
+            size=size,
+            shape="1|2",
+            sharecam=False,
+            offscreen=offscreen,
+            title="Welsh Embryonic Mouse Staging System",
+        )
+        self.plt.at(0).add(version_text())
+        self.panel = calibration_panel(self.calibration)
+        self.plt.at(2).add(self.panel.actors)
+        self.plt.at(2).show(camera=CALIBRATION_CAMERA, interactive=False)
+        self.plt.background("w", "#dceef4")
+        self._actors = [[], []]  # per-limb actors of the two outline panels
+
+    def _replace(self, at, actors):
+        if self._actors[at]:
+            self.plt.at(at).remove(*self._actors[at])
+        self.plt.at(at).add(actors)
+        self._actors[at] = actors
+
+    def render(self, datapoints, embryoname):
+        """Stage one limb and write <name>_staging.png and <name>.txt to outdir.
+        Returns a dict with the filename of the image, age, sigma and chi2
+        (filename is None if no solution is found)."""
+        result, vobj = descriptors(datapoints, do_plots=True)
+        if not len(vobj):
+            return dict(filename=None, age=0, sigma=0, chi2=0.0)
+        _, q, best_age, sigma, best_score = self.calibration.lookup(result)
+
+        self._replace(0, vobj[:-1] + embryo_texts(embryoname, best_age, sigma))
+        self.plt.reset_camera(tight=0.04)
+        self._replace(1, [vobj[-1]])
+        self.plt.reset_camera(tight=0.04)
+        self.panel.update(result, q, best_score)
+        self.plt.render()
+
+        filename = write_staging_outputs(self.plt, datapoints, embryoname, self.outdir)
+        return dict(filename=filename, age=best_age, sigma=sigma, chi2=best_score)
+
+    def close(self):
+        self.plt.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+
+def render_reports(filenames, outdir="output", calibration=None, verbose=True):
+    """Write a staging report for every limb in the MEASURED .txt files."""
+    limbs = read_limb_files(filenames, fitshape=False)
+    reports = []
+    with ReportRenderer(calibration, outdir) as renderer:
+        for i, name in enumerate(limbs.names):
+            datapoints = limbs.measured_points(i)
+            if not limbs.meta["ok"][i] or len(datapoints) <= 5:
+                rep = dict(filename=None, age=0, sigma=0, chi2=0.0)
+            else:
+                if ":" in name:  # i-th limb of a file with several limbs
+                    fname, k = name.rsplit(":", 1)
+                    base, ext = os.path.splitext(fname)
+                    name = f"{base}_{k}{ext}"
+                rep = renderer.render(datapoints, name)
+            reports.append(dict(name=name, **rep))
+            if verbose:
+                if rep["filename"]:
+                    print(f"{name}: {rep['age']}h :pm{rep['sigma']}h -> {rep['filename']}")
+                else:
+                    print(f"{name}: could not find a solution, no report")
+    return reports
+
+
+#################################################################################
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="welsh_stager off-screen reports")
+    parser.add_argument("inputs", nargs="+", help="txt files, directories, globs or @filelist")
+    parser.add_argument("--outdir", default="output", help="directory of the png and txt outputs")
+    args = parser.parse_args()
+
+    filenames = collect_inputs(args.inputs)
+    if not filenames:
+        print("\nNo txt files with MEASURED points found.\n")
+    else:
+        render_reports(filenames, args.outdir)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Staging server: keeps the calibration in memory and stages limbs sent
+by other processes over HTTP (TCP or Unix socket), answering in JSON.
+
+    python server.py --port 8765
+    python server.py --unix /tmp/stager.sock --workers 4
+
+Endpoints:
+    GET  /health         -> {"status": "ok", "version": ...}
+    POST /predict        {"points": [[x, y], ...], "name": "optional"}
+                         -> {"name", "age", "age_string", "sigma", "chi2",
+                             "area", "aratio", "parabolic", "status"}
+    POST /predict_batch  {"limbs": [[[x, y], ...], ...], "names": [...]}
+                         -> {"results": [{...}, ...]}
+    Both POST endpoints accept "bootstrap": n to add the age interval of n
+    perturbed replicates of each limb (see uncertainty.py).
+
+Staging runs in a pool of workers off the event loop, so a slow or large
+request does not block the others. E.g.:
+    curl -s localhost:8765/predict -d '{"points": [[1465.3, 1536.9], ...]}'
+"""
+import argparse
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+from calibration import get_calibration
+from stager import stage_many, _version
+
+MAX_BODY = 64 * 1024 * 1024  # bytes
+MAX_BOOTSTRAP = 10000  # replicates per limb
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+            413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _as_points(points):
+    pts = np.asarray(points, dtype=float)
+    if pts.ndim != 2 or pts.shape[1] not in (2, 3):
+        raise RequestError(400, "points must be a list of [x, y] or [x, y, z]")
+    if pts.shape[1] == 2:
+        pts = np.c_[pts, np.zeros(len(pts))]
+    return pts
+
+
+def _warm_up():
+    # runs once in every worker: imports are done, load the calibration and its index
+    get_calibration().lookup_many(np.zeros((1, 3)))
+
+
+def _stage_rows(limbs, names, bootstrap=0):
+    # runs in the worker pool
+    rows = stage_many(limbs, bootstrap=bootstrap)
+    return [dict(name=name, **row) for name, row in zip(names, rows)]
+
+
+#################################################################################
+class StagingServer:
+    """Asyncio HTTP server that stages limbs with a warm calibration model."""
+
+    def __init__(self, workers=None, processes=False):
+        _warm_up()
+        workers = workers or os.cpu_count() or 1
+        if processes:
+            self.pool = ProcessPoolExecutor(max_workers=workers, initializer=_warm_up)
+        else:
+            self.pool = ThreadPoolExecutor(max_workers=workers)
+        # start all the workers now, not on the first requests
+        for future in [self.pool.submit(int) for _ in range(workers)]:
+            future.result()
+
+    async def stage(self, limbs, names, bootstrap=0):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, _stage_rows, limbs, names, bootstrap)
+
+    async def route(self, method, path, body):
+        if path == "/health":
+            return 200, {"status": "ok", "version": _version}
+        if path not in ("/predict", "/predict_batch"):
+            raise RequestError(404, f"unknown endpoint {path}")
+        if method != "POST":
+            raise RequestError(405, "use POST")
+        try:
+            data = json.loads(body or b"{}")
+        except ValueError:
+            raise RequestError(400, "body is not valid JSON")
+        if not isinstance(data, dict):
+            raise RequestError(400, "body must be a JSON object")
+        bootstrap = data.get("bootstrap", 0)
+        # bool is a subclass of int, "bootstrap": true is not a number of replicates
+        if isinstance(bootstrap, bool) or not isinstance(bootstrap, int) or not 0 <= bootstrap <= MAX_BOOTSTRAP:
+            raise RequestError(400, f"'bootstrap' must be an integer between 0 and {MAX_BOOTSTRAP}")
+
+        if path == "/predict":
+            if "points" not in data:
+                raise RequestError(400, "missing 'points'")
+            rows = await self.stage([_as_points(data["points"])], [data.get("name", "")], bootstrap)
+            return 200, rows[0]
+
+        limbs = data.get("limbs")
+        if not isinstance(limbs, list):
+            raise RequestError(400, "missing 'limbs' list")
+        names = data.get("names") or [str(i) for i in range(len(limbs))]
+        if not isinstance(names, list):
+            raise RequestError(400, "'names' must be a list")
+        if len(names) != len(limbs):
+            raise RequestError(400, "'names' and 'limbs' have different lengths")
+        rows = await self.stage([_as_points(p) for p in limbs], names, bootstrap)
+        return 200, {"results": rows}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                keep_alive = headers.get("connection", "").lower() != "close"
+
+                try:
+                    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                    length = int(headers.get("content-length", 0))
+                    if length > MAX_BODY:
+                        keep_alive = False
+                        raise RequestError(413, "request body too large")
+                    body = await reader.readexactly(length) if length else b""
+                    status, payload = await self.route(method, path.split("?")[0], body)
+                except RequestError as e:
+                    status, payload = e.status, {"error": str(e)}
+                except ValueError as e:
+                    status, payload = 400, {"error": str(e)}
+                except Exception as e:
+                    status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+
+                out = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(out)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+                    + out
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8765, unix=""):
+        if unix:
+            server = await asyncio.start_unix_server(self.handle, path=unix)
+            where = unix
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            where = f"http://{host}:{port}"
+        print(f"{_version} staging server listening on {where}")
+        async with server:
+            await server.serve_forever()
+
+
+#################################################################################
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="welsh_stager staging server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", default="", help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=None, help="number of staging workers")
+    parser.add_argument("--processes", action="store_true",
+                        help="stage in worker processes instead of threads")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(StagingServer(args.workers, args.processes).serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
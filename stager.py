@@ -1,19 +1,20 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # Using vedo 2024.5.1
-import os, sys
+import os, sys, time, csv, json, argparse, weakref
 from glob import glob
+from functools import partial
 from datetime import datetime
 import numpy as np
-from vedo import __version__ as _vedo_version
-from vedo import settings, mag, precision, load, sys_platform, show
-from vedo import fit_circle, printc, Plotter, Text2D, Sphere
-from vedo import Line, Ribbon, Spline, Points, Axes, Circle, Point, Image
-from vedo.utils import sort_by_column
-from vedo.pyplot import plot, histogram
-from vedo.applications import SplinePlotter
-from utils import Limb, read_measured_points
-from utils import find_extrema, fit_parabola, age_as_string, fdays
+# vedo (and therefore VTK) is imported only by the functions that draw,
+# so that the numerical core can be used without loading any rendering module
+from utils import Limb, read_measured_points, read_limb_files
+from calibration import get_calibration
+from limbshape import shape_descriptors, descriptors_batch, outline_descriptors
+from cache import DescriptorCache
+from instrument import Instrument, current
+from uncertainty import bootstrap_many, bootstrap_columns, summarize_ages, BOOTSTRAP_COLUMNS
+from utils import age_as_string, fdays, parallel_map
 
 _version = "welsh_stager v0.5"
 
@@ -21,20 +22,51 @@ _version = "welsh_stager v0.5"
 datadir = "data/staged_welsh_reduced/"  # for training only
 
 
-def plot_stats(do_plots=0):
-    ages = []
-    nominal_ages = []
-    errors = []
-    scores = []
-    for f in glob(os.path.join(datadir, "*.txt")):
-        embryo = Limb(f, author="welsh")
-        result = predict(embryo.datapoints, do_plots=0)
-        _, best_age, sigma, best_score = result
-        ages.append(best_age)
-        nominal_ages.append(embryo.age)
-        errors.append(sigma)
-        scores.append(best_score)
-        # if sigma<2:  print(embryo.filename, sigma)
+def training_descriptors(presample=False, workers=None, chunksize=None, use_cache=True):
+    """Descriptors and nominal ages of all the training files in datadir,
+    computed in parallel. Files are sorted so results are reproducible.
+    With use_cache, descriptors are stored in a cache file next to datadir
+    and only new or modified limbs are computed."""
+    filenames = sorted(glob(os.path.join(datadir, "*.txt")))
+    limbs = [Limb(f, author="welsh") for f in filenames]
+    ages = np.array([limb.age for limb in limbs])
+    results = np.zeros((len(limbs), 3))
+
+    todo = list(range(len(limbs)))
+    if use_cache:
+        cache = DescriptorCache(os.path.normpath(datadir) + "_descriptors.sqlite")
+        keys = [cache.key(limb.datapoints, presample=presample) for limb in limbs]
+        found = cache.get_many(keys)
+        todo = [i for i, k in enumerate(keys) if k not in found]
+        for i, k in enumerate(keys):
+            if k in found:
+                results[i] = found[k]
+
+    func = partial(outline_descriptors, presample=presample)
+    out = parallel_map(func, [limbs[i].datapoints for i in todo], workers=workers, chunksize=chunksize)
+    for i, result in zip(todo, out):
+        results[i] = result
+
+    if use_cache:
+        cache.put_many([(keys[i], results[i]) for i in todo])
+        cache.close()
+        print(f"Descriptors: {len(limbs) - len(todo)} from cache, {len(todo)} computed")
+    return filenames, results, ages
+
+
+def plot_stats(do_plots=0, calibration=None, workers=None):
+    from vedo import Line
+    from vedo.pyplot import plot, histogram
+
+    if calibration is None:
+        calibration = get_calibration()
+
+    _, results, nominal_ages = training_descriptors(workers=workers)
+    res = calibration.lookup_many(results)
+    ages = res["age"]
+    errors = res["sigma"]
+    scores = res["score"]
+    # for f, s in zip(filenames, errors): if s<2: print(f, s)
 
     histogram(ages, xlim=(320, 370), bins=25, xtitle="age").show().close()
     histogram(scores, xtitle="scores", c="r4").show().close()
@@ -51,15 +83,15 @@ def plot_stats(do_plots=0):
 
 
 ###################
-def plot_2d_cloud():
+def plot_2d_cloud(workers=None):
+    from vedo import Points, show
+
     tits = "area", "aratio", "parabolic"
     limb_desc = []
-    for filename in glob(os.path.join(datadir, "*.txt")):
-        embryo = Limb(filename, author="welsh")
-        spline = Spline(embryo.datapoints, res=200)
-        area, aratio, parabolic = descriptors(spline.vertices, do_plots=0)
+    filenames, results, ages = training_descriptors(presample=True, workers=workers)
+    for filename, (area, aratio, parabolic), age in zip(filenames, results, ages):
         if area:
-            limb_desc.append([area, aratio, embryo.age])
+            limb_desc.append([area, aratio, age])
         else:
             print("zero area for", filename)
     limb_desc = np.array(limb_desc)
@@ -73,7 +105,12 @@ def plot_2d_cloud():
 
 
 ##################################################################
-def generate_calibration_welsh(selected_agegroup=348, smooth=0.1):
+def generate_calibration_welsh(selected_agegroup=348, smooth=0.1, workers=None):
+    # interactive version, for a headless and incremental build see calibrate.py
+    from vedo import settings, printc, show, Points, Line, Spline, Point
+    from calibrate import CALIBRATION_IDS, CALIBRATION_AGEGROUPS
+    from vedo.utils import sort_by_column
+    from vedo.pyplot import plot
 
     settings.use_parallel_projection = True  # press u to toggle
 
@@ -92,19 +129,16 @@ def generate_calibration_welsh(selected_agegroup=348, smooth=0.1):
     tits = "area", "aspect ratio", "parabolic"
 
     limb_desc, ages, names, agegroup_pts = [], [], [], []
-    for filename in glob(os.path.join(datadir, "*.txt")):
-        embryo = Limb(filename, author="welsh")
-        spline = Spline(embryo.datapoints, res=200)
-
-        result, vobj = descriptors(spline.vertices)
+    filenames, results, embryo_ages = training_descriptors(presample=True, workers=workers)
+    for filename, result, embryo_age in zip(filenames, results, embryo_ages):
         if result[0]:
-            if embryo.age == selected_agegroup:
+            if embryo_age == selected_agegroup:
                 agegroup_pts.append(result)
                 n = os.path.basename(filename)
                 n = n.replace(".txt", "").replace("_LHL", "").replace("_RHL", "").replace("_", "\_")
                 names.append(n)
             limb_desc.append(result)
-            ages.append(embryo.age)
+            ages.append(embryo_age)
         else:
             print("Error: zero area for", filename)
 
@@ -135,8 +169,7 @@ def generate_calibration_welsh(selected_agegroup=348, smooth=0.1):
 
     ######### GENERATE and save the calibration curve
     # (the first and last agegroups are extrapolations)
-    ids       = np.array([  0,   6,  11,  21,  44,  64,  77,  99]) # step along the aveline_s
-    agegroups = np.array([318, 324, 330, 336, 342, 348, 354, 366]) # average age at that point
+    ids, agegroups = CALIBRATION_IDS, CALIBRATION_AGEGROUPS  # step along aveline_s, average age there
     index = np.where(agegroups==selected_agegroup)[0][0]
 
     calib = np.c_[ids, agegroups]
@@ -173,53 +206,28 @@ def generate_calibration_welsh(selected_agegroup=348, smooth=0.1):
 #####################################################################
 def descriptors(datapoints, do_plots=False):
 
-    eline = Spline(datapoints, res=200).c("b3").lw(4)
-    eline.scale(1 / eline.average_size())
-
-    ## first round ##
-    cm1 = eline.center_of_mass()
-    epts = eline.vertices
-    data_y = mag(epts - cm1)
-    # Find peaks and valleys
-    peak_x, green_peaks = find_extrema(data_y, n=5)
-    valley_x, red_valleys = find_extrema(data_y, n=6, invert=True)
-    if len(peak_x) == 0 or len(valley_x) == 0:
-        return (0, 0, 0), []
-
-    ## second round ##
-    cm2, r2, _ = fit_circle(epts[peak_x])
-    if not r2:
-        return (0, 0, 0), []
-    data_y = mag(epts - cm2)
-    # Find peaks and valleys
-    peak_x, green_peaks = find_extrema(data_y, n=5)
-    valley_x, red_valleys = find_extrema(data_y, n=6, invert=True)
-    if len(peak_x) == 0 or len(valley_x) == 0:
+    # the numerical work is done in limbshape without allocating VTK objects
+    result, info = shape_descriptors(datapoints, details=True)
+    if not info:
         return (0, 0, 0), []
+    area, aratio, parabolic = result / 10
 
-    ## third round ##
-    cm3, r3, _ = fit_circle(epts[peak_x])
-    if not r3:
-        return (0, 0, 0), []
-    data_y = mag(epts - cm3)
-    # Find peaks and valleys
-    peak_x, green_peaks = find_extrema(data_y, n=5)
-    valley_x, red_valleys = find_extrema(data_y, n=6, invert=True)
-    if len(peak_x) == 0 or len(valley_x) == 0:
-        return (0, 0, 0), []
-
-    rib = Ribbon(green_peaks, red_valleys, alpha=0.1).z(0.1).lighting("off")
-    area = rib.clean().triangulate().area() / r3 / 10
-    xb = rib.xbounds()
-    yb = rib.ybounds()
-    aratio = 1000 * (yb[1] - yb[0]) / (xb[1] - xb[0]) / r3
-
-    fitpar, parabolapts = fit_parabola(valley_x, red_valleys[:, 1])
-    parabolic = 2e04 * fitpar[0] + 1
+    epts = info["epts"]
+    data_y = info["data_y"]
+    cm1, cm2, cm3 = info["cms"]
+    r3 = info["r3"]
+    peak_x, valley_x = info["peak_x"], info["valley_x"]
+    green_peaks, red_valleys = info["green_peaks"], info["red_valleys"]
+    parabolapts = info["parabolapts"]
 
     ############ generate vedo obects for viz
     vobjs = []
     if do_plots:
+        from vedo import precision, Line, Ribbon, Points, Circle, Point, Axes
+        from vedo.pyplot import plot
+
+        eline = Line(epts).c("b3").lw(4)
+        rib = Ribbon(green_peaks, red_valleys, alpha=0.1).z(0.1).lighting("off")
         t = f"area={precision(area,3)},"
         t += f" a\_ratio={precision(aratio,3)},"
         t += f" parabolic={precision(parabolic,3)}"
@@ -245,77 +253,173 @@ def descriptors(datapoints, do_plots=False):
         # plt.show(fig, at=1, zoom=1.15, mode='image').interactive().close()
     ########################
 
-    result = np.array([area, aratio, parabolic]) * 10
     return result, vobjs
 
 
 #####################################################################
-def predict(datapoints, embryoname="", do_plots=True):
+# camera of the 3D calibration panel
+CALIBRATION_CAMERA = dict(
+    pos=(66.85, -24.10, 42.42),
+    focalPoint=(34.89, 20.37, 9.009),
+    viewup=(-0.2861, 0.4357, 0.8534),
+    distance=64.14,
+)
+
+
+def username():
+    try:
+        return os.getlogin()
+    except OSError:  # no controlling terminal, e.g. on a headless server
+        import getpass
+
+        return getpass.getuser()
+
+
+def calibration_actors(calibration):
+    """Actors of the 3D panel that do not depend on the embryo: the calibration
+    curve, its shadow, the ribbon joining them and the axes."""
+    from vedo import Ribbon, Axes
+
+    tcourse = calibration.spline.clone().c("k").lw(5)
+    axes = Axes(
+        tcourse,
+        xtitle="area",
+        ytitle="aspect ratio",
+        ztitle="parabolic",
+        xtitle_backface_color="t",
+        ytitle_backface_color="t",
+        ztitle_backface_color="t",
+    )
+    zshad = tcourse.zbounds()[0]
+    tcourse.add_shadow(plane="z", point=zshad).lw(1)
+    tcourse_shad = tcourse.shadows[0].lw(1)
+    ribtc = Ribbon(tcourse, tcourse_shad).c("k").alpha(0.1).lighting("off")
+    return [tcourse, tcourse_shad, ribtc, axes]
+
+
+def _chi2_message(best_score):
+    from vedo import precision
+
+    return f":chi:^2 = {precision(best_score,2)}"
+
+
+def embryo_actors(result, q, best_score):
+    """Actors of the 3D panel for one embryo: its point in descriptor space,
+    the segment to the closest point of the curve, the uncertainty sphere and chi2."""
+    from vedo import Text2D, Sphere, Line, Point
+
+    pt = Point(result, r=15, c="r5")
+    joinline = Line(result, q).lw(3).c("g5")
+    err_sphere = Sphere(result, r=best_score * 1.2, c="r5", alpha=0.1)
+    chi2msg = Text2D(_chi2_message(best_score), pos="top-right", s=1.1, font="Kanopus")
+    return [pt, joinline, err_sphere, chi2msg]
+
+
+class CalibrationPanel:
+    """The 3D panel of the staging report for one calibration: the static actors
+    are built once, the actors of the embryo are moved in place by update()."""
+
+    def __init__(self, calibration):
+        self.spline = calibration.spline  # to know when the calibration is reloaded
+        self.static = calibration_actors(calibration)
+        self.embryo = embryo_actors(np.zeros(3), np.ones(3), 1.0)
+        self._unit_sphere = self.embryo[2].vertices / 1.2
+
+    @property
+    def actors(self):
+        return self.static + self.embryo
+
+    def update(self, result, q, best_score):
+        """Show the embryo at result, q being the closest point of the curve."""
+        pt, joinline, err_sphere, chi2msg = self.embryo
+        pt.vertices = [result]
+        joinline.vertices = [result, q]
+        err_sphere.vertices = self._unit_sphere * (best_score * 1.2) + result
+        chi2msg.text(_chi2_message(best_score))
+        return self
+
+
+_panels = weakref.WeakKeyDictionary()
+
+
+def calibration_panel(calibration):
+    """The CalibrationPanel of a calibration, built on first use and then reused
+    (rebuilt if the calibration was reloaded)."""
+    panel = _panels.get(calibration)
+    if panel is None or panel.spline is not calibration.spline:
+        panel = _panels[calibration] = CalibrationPanel(calibration)
+    return panel
+
+
+def embryo_texts(embryoname, best_age, sigma):
+    from vedo import Text2D
+
+    txtf = Text2D(
+        f"{embryoname}\nEmbryo is"
+        f" {age_as_string(best_age)} :pm{sigma}h"
+        f" (or E{fdays(best_age)}, {int(best_age+0.5)}h) ",
+        pos="top-left",
+        bg="purple6",
+        s=1.2,
+        alpha=0.7,
+    )
+    now = Text2D(
+        f'User: {username()}, {datetime.now().strftime("%c")}', pos="bottom-left", s=0.8,
+    )
+    return [txtf, now]
+
+
+def version_text():
+    from vedo import __version__ as _vedo_version
+    from vedo import Text2D
 
-    result, vobj = descriptors(datapoints, do_plots=do_plots)
+    return Text2D(f"{_version}, vedo {_vedo_version}", pos="bottom-right", s=0.7)
 
-    tcourse = load(os.path.join("tuning", "calibration_spline.vtk")).c("k").lw(5)
-    # tcourse = load('https://github.com/marcomusy/welsh_embryo_stager/blob/main/tuning/calibration_spline.vtk').c('k').lw(5)
 
-    # the id (or step) is what we need to map to age
-    idn = tcourse.closest_point(result, return_point_id=True)
-    q = tcourse.vertices[idn]
+def write_staging_outputs(plt, datapoints, embryoname, outdir="output"):
+    """Save the screenshot of plt as <name>_staging.png and the points as <name>.txt."""
+    basename = os.path.splitext(embryoname)[0]
 
-    # find the closest entry in the calibration curve
-    calib = load(os.path.join("tuning", "calibration_table.vtk")).vertices
-    # calib = load('https://github.com/marcomusy/welsh_embryo_stager/blob/main/tuning/calibration_table.vtk').vertices
+    outf = os.path.join(outdir, basename + "_staging.png")
+    plt.screenshot(outf)
 
-    idt = (np.abs(calib[:, 0] - idn)).argmin()
-    best_age = round(calib[idt][1])
-    best_score = mag(result - q)
+    # create a txt file
+    write_measured_points(os.path.join(outdir, basename + ".txt"), datapoints)
+    return outf
 
-    r = best_score * 1.2
-    sigma = len(tcourse.closest_point(result, radius=r, return_point_id=True))
-    sigma = round((sigma + 1) / 2)  # heuristic
+
+def write_measured_points(filename, datapoints):
+    """Write points as a MEASURED .txt file that can be staged again."""
+    basename = os.path.splitext(os.path.basename(filename))[0]
+    with open(filename, "w") as f:
+        f.write(f"{username()} {basename}  u 1.0  0 0 0 0 {len(datapoints)}\n")
+        for p in datapoints:
+            f.write(f"MEASURED {p[0]} {p[1]}\n")
+    return filename
+
+
+#####################################################################
+def predict(datapoints, embryoname="", do_plots=True, calibration=None):
+
+    if calibration is None:
+        calibration = get_calibration()
+
+    ins = current()
+    with ins.timer("descriptors"):
+        result, vobj = descriptors(datapoints, do_plots=do_plots)
+    with ins.timer("lookup"):
+        _, q, best_age, sigma, best_score = calibration.lookup(result)
     pic_array = None
 
     if do_plots:
-        err_sphere = Sphere(result, r=r, c="r5", alpha=0.1)
-        axes = Axes(
-            tcourse,
-            xtitle="area",
-            ytitle="aspect ratio",
-            ztitle="parabolic",
-            xtitle_backface_color="t",
-            ytitle_backface_color="t",
-            ztitle_backface_color="t",
-        )
-        pt = Point(result, r=15, c="r5")
-        zshad = tcourse.zbounds()[0]
-
-        joinline = Line(result, q).lw(3).c("g5")
-
-        tcourse.add_shadow(plane="z", point=zshad).lw(1)
-        tcourse_shad = tcourse.shadows[0].lw(1)
-        ribtc = Ribbon(tcourse, tcourse_shad).c("k").alpha(0.1).lighting("off")
-
-        txtf = Text2D(
-            f"{embryoname}\nEmbryo is"
-            f" {age_as_string(best_age)} :pm{sigma}h"
-            f" (or E{fdays(best_age)}, {int(best_age+0.5)}h) ",
-            pos="top-left",
-            bg="purple6",
-            s=1.2,
-            alpha=0.7,
-        )
-
-        now = Text2D(
-            f'User: {os.getlogin()}, {datetime.now().strftime("%c")}', pos="bottom-left", s=0.8,
-        )
-        vers = Text2D(f"{_version}, vedo {_vedo_version}", pos="bottom-right", s=0.7)
-        chi2msg = Text2D(
-            f":chi:^2 = {precision(best_score,2)}", pos="top-right", s=1.1, font="Kanopus",
-        )
+        from vedo import Plotter
 
         if not len(vobj):
             print("\nERROR: Could not find a solution. Try again with new points!\n")
             return [], 0, 0, 0
 
+        panel = calibration_panel(calibration).update(result, q, best_score)
+
         plt = Plotter(
             size=(1800, 1000),
             shape="1|2",
@@ -323,35 +427,16 @@ def predict(datapoints, embryoname="", do_plots=True):
             title="Welsh Embryonic Mouse Staging System",
         )
 
-        plt.at(0).show(vobj[:-1] + [txtf, now, vers], zoom="tight")
+        plt.at(0).show(vobj[:-1] + embryo_texts(embryoname, best_age, sigma) + [version_text()], zoom="tight")
         plt.at(1).show(vobj[-1], zoom="tight")
-
-        cam = dict(
-            pos=(66.85, -24.10, 42.42),
-            focalPoint=(34.89, 20.37, 9.009),
-            viewup=(-0.2861, 0.4357, 0.8534),
-            distance=64.14,
-        )
-        plt.at(2).show(
-            tcourse, pt, joinline, tcourse_shad, ribtc, err_sphere, axes, chi2msg, camera=cam,
-        )
+        plt.at(2).show(panel.actors, camera=CALIBRATION_CAMERA)
         plt.background("w", "#dceef4")
 
         # create a png and text file
         if os.path.isdir("output"):
-            basename, file_extension = os.path.splitext(embryoname)
-
-            outf = os.path.join("output", embryoname.replace(file_extension, "_staging.png"))
-            plt.screenshot(outf)
+            write_staging_outputs(plt, datapoints, embryoname)
             # pic_array = plt.screenshot(asarray=True)
-
-            # create a txt file
-            outf = os.path.join("output", embryoname.replace(file_extension, ".txt"))
-            with open(outf, "w") as f:
-                f.write(f"{os.getlogin()} {basename}  u 1.0  0 0 0 0 {len(datapoints)}\n")
-                for p in datapoints:
-                    f.write(f"MEASURED {p[0]} {p[1]}\n")
-            print(f"Output image and txt data saved to output/{basename}*")
+            print(f"Output image and txt data saved to output/{os.path.splitext(embryoname)[0]}*")
         else:
             print("\nYou don't have a local directory 'output' so cannot write to it. Skip.\n")
             # pic_array = plt.screenshot(asarray=True)
@@ -362,20 +447,361 @@ def predict(datapoints, embryoname="", do_plots=True):
 
 
 #####################################################################
-if __name__ == "__main__":
+def collect_inputs(sources):
+    """Expand directories, glob patterns and @file-lists into a sorted list of .txt files."""
+    filenames = []
+    for src in sources:
+        if src.startswith("@"):  # a text file listing one path per line
+            with open(src[1:], "r") as f:
+                listed = [l.strip() for l in f if l.strip() and not l.startswith("#")]
+            filenames += collect_inputs(listed)
+        elif os.path.isdir(src):
+            filenames += glob(os.path.join(src, "*.txt"))
+        elif os.path.isfile(src):
+            filenames.append(src)
+        else:
+            filenames += [f for f in glob(src) if os.path.isfile(f)]
+    return sorted(set(f for f in filenames if f.lower().endswith(".txt")))
+
+
+def _empty_row(status="ok"):
+    return dict(age=0, age_string="", sigma=0, chi2=0.0,
+                area=0.0, aratio=0.0, parabolic=0.0, status=status)
+
+
+def stage_many(datapoints_list, calibration=None, bootstrap=0, errors=None):
+    """Stage a list of limbs without any rendering, one dict of results per limb.
+    Descriptors and calibration lookup are computed for all limbs at once.
+    With bootstrap=n the age distribution of n perturbed replicates of each
+    limb is also computed (see uncertainty.py) and added to the rows.
+    errors maps limb indices to a status, these limbs are not staged."""
+    if calibration is None:
+        calibration = get_calibration()
+    ins = current()
+    rows = [_empty_row() for _ in datapoints_list]
+    for i, datapoints in enumerate(datapoints_list):
+        if errors and i in errors:
+            rows[i]["status"] = errors[i]
+        elif len(datapoints) <= 5:
+            rows[i]["status"] = "not enough points"
+    todo = [i for i, row in enumerate(rows) if row["status"] == "ok"]
+    results = np.zeros((len(rows), 3))
+    nfailures = len(ins.failures) if ins else 0
+    with ins.timer("descriptors"):
+        if todo:
+            results[todo] = descriptors_batch([datapoints_list[i] for i in todo])
+    if ins:
+        for failure in ins.failures[nfailures:]:  # index in todo -> limb index
+            if failure["limb"] is not None:
+                failure["limb"] = todo[failure["limb"]]
+    good = []
+    for i, result in enumerate(results):
+        if rows[i]["status"] != "ok":
+            continue
+        rows[i].update(area=result[0], aratio=result[1], parabolic=result[2])
+        if not result[0]:
+            rows[i]["status"] = "no solution"
+            continue
+        good.append(i)
+    if good:
+        with ins.timer("lookup"):
+            res = calibration.lookup_many(results[good])
+        for j, i in enumerate(good):
+            age = int(res["age"][j])
+            rows[i].update(
+                age=age,
+                age_string=age_as_string(age),
+                sigma=int(res["sigma"][j]),
+                chi2=float(res["score"][j]),
+            )
+    if bootstrap:
+        empty = bootstrap_columns(summarize_ages([]))
+        for row in rows:
+            row.update(empty)
+        summaries = bootstrap_many([datapoints_list[i] for i in good], bootstrap, calibration)
+        for i, summary in zip(good, summaries):
+            rows[i].update(bootstrap_columns(summary))
+    if ins:
+        ins.count("limbs", len(rows))
+        for row in rows:
+            ins.count(f"status {row['status']}")
+    return rows
+
+
+def stage(datapoints, calibration=None, bootstrap=0):
+    """Stage a single limb without any rendering. Returns a dict of results."""
+    return stage_many([datapoints], calibration, bootstrap)[0]
+
+
+def stage_batch(filenames, calibration=None, verbose=True, bootstrap=0):
+    """Stage many MEASURED .txt files headlessly, one result row per limb.
+    Files with several concatenated limbs give one row per limb.
+    bootstrap is passed to stage_many()."""
+    t0 = time.perf_counter()
+    ins = current()
+    names, datapoints_list, errors = [], [], {}
+    try:
+        limbs = [read_limb_files(filenames, fitshape=False)]
+    except (OSError, UnicodeDecodeError):
+        limbs = []  # read file by file to find out which ones are broken
+        for filename in filenames:
+            try:
+                limbs.append(read_limb_files(filename, fitshape=False))
+            except (OSError, UnicodeDecodeError) as e:
+                errors[len(names)] = f"error: {e}"
+                names.append(os.path.basename(filename))
+                datapoints_list.append([])
+    for lm in limbs:
+        for i in range(len(lm)):
+            if not lm.meta["ok"][i]:
+                errors[len(names)] = "error: could not parse points"
+            names.append(lm.names[i])
+            datapoints_list.append(lm.measured_points(i))
+
+    ins.add_time("read", time.perf_counter() - t0)
+
+    nfailures = len(ins.failures) if ins else 0
+    rows = stage_many(datapoints_list, calibration, bootstrap, errors)
+    if ins:
+        for failure in ins.failures[nfailures:]:  # limb index -> name
+            if failure["limb"] is not None:
+                failure["limb"] = names[failure["limb"]]
+    for i, name in enumerate(names):
+        rows[i] = dict(name=name, **rows[i])
+        if verbose and rows[i]["status"] != "ok":
+            print(f"{name}: {rows[i]['status']}")
+
+    elapsed = time.perf_counter() - t0
+    if verbose and rows:
+        nok = sum(r["status"] == "ok" for r in rows)
+        print(
+            f"Staged {nok}/{len(rows)} limbs in {elapsed:.2f}s"
+            f" ({len(rows) / max(elapsed, 1e-9):.1f} limbs/s,"
+            f" {1000 * elapsed / len(rows):.2f} ms/limb)"
+        )
+    return rows
+
+
+TABLE_COLUMNS = ["name", "age", "age_string", "sigma", "chi2", "area", "aratio", "parabolic", "status"]
+
+
+def write_table(rows, filename):
+    """Write result rows to a .csv file, or to .parquet (requires pandas+pyarrow)."""
+    columns = TABLE_COLUMNS
+    if rows and BOOTSTRAP_COLUMNS[0] in rows[0]:
+        columns = TABLE_COLUMNS + BOOTSTRAP_COLUMNS
+    if filename.lower().endswith(".parquet"):
+        try:
+            import pandas as pd
+        except ImportError:
+            print("Writing parquet files requires pandas and pyarrow, please install them.")
+            return False
+        pd.DataFrame(rows, columns=columns).to_parquet(filename, index=False)
+    else:
+        with open(filename, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow({k: row[k] for k in columns})
+    print(f"Results for {len(rows)} limbs saved to {filename}")
+    return True
+
+
+def append_table(rows, filename):
+    """Append result rows to a .csv file, the header is written if the file is new."""
+    new = not os.path.isfile(filename) or os.path.getsize(filename) == 0
+    with open(filename, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=TABLE_COLUMNS)
+        if new:
+            writer.writeheader()
+        for row in rows:
+            writer.writerow({k: row[k] for k in TABLE_COLUMNS})
+
+
+def _watch_state_file(output):
+    # not a .txt file: it may be in the watched directory
+    return os.path.splitext(output)[0] + "_watched.jsonl"
+
+
+def _previously_staged(output):
+    """Files staged into output by earlier sessions: a set of (name, size, mtime_ns)
+    from the state file next to it, or for older outputs without it a set of
+    names of the rows that were staged without errors."""
+    state = _watch_state_file(output)
+    if os.path.isfile(state):
+        seen = set()
+        with open(state) as f:
+            for line in f:
+                name, size, mtime = json.loads(line)
+                seen.add((name, size, mtime))
+        return seen
+    names = set()
+    if os.path.isfile(output):
+        with open(output, newline="") as f:
+            names = {row["name"].rsplit(":", 1)[0] for row in csv.DictReader(f) if row["status"] == "ok"}
+    return names
+
+
+def watch_directory(directory, output, interval=2.0, settle=1.0, batch_size=500,
+                    calibration=None, once=False, max_wait=600.0):
+    """Stage the MEASURED .txt files appearing in directory and append the results to output.
+
+    A file is staged once its size and modification time have not changed for
+    a whole polling interval and it is at least settle seconds old, so files
+    that are still being written are skipped until complete. All files ready
+    at a poll are staged together in batches of batch_size limbs.
+    Name, size and modification time of the staged files are kept in
+    <output>_watched.jsonl: a file is not staged again unless it changes, in this
+    session or after a restart, and then it gets a new row.
+    Files that stay empty or keep changing for max_wait seconds are given up
+    until they change again, files deleted before being staged are forgotten.
+    With once=True return when no file is left pending, otherwise run until Ctrl-C.
+    """
+    done = {}  # path -> (size, mtime) when it was staged
+    pending = {}  # path -> ((size, mtime) at the previous poll, time first seen)
+    previous = _previously_staged(output)
+    state = open(_watch_state_file(output), "a")
+    own_files = {os.path.realpath(output), os.path.realpath(state.name)}
+    nstaged = 0
+    print(f"Watching {directory}, results are appended to {output} (Ctrl-C to stop)")
+    try:
+        while True:
+            ready = []
+            seen = set()
+            now = time.time()
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if not entry.name.lower().endswith(".txt") or not entry.is_file():
+                        continue
+                    if os.path.realpath(entry.path) in own_files:
+                        continue
+                    st = entry.stat()
+                    sig = (st.st_size, st.st_mtime_ns)
+                    if done.get(entry.path) == sig:
+                        continue
+                    if entry.path not in done and ((entry.name, *sig) in previous or entry.name in previous):
+                        done[entry.path] = sig  # staged in a previous session
+                        continue
+                    seen.add(entry.path)
+                    last, since = pending.get(entry.path, (None, now))
+                    if last == sig and st.st_size and now - st.st_mtime >= settle:
+                        ready.append(entry.path)
+                    elif now - since > max_wait:
+                        print(f"{entry.name}: still empty or changing after {max_wait:.0f}s, skipped")
+                        done[entry.path] = sig
+                        seen.discard(entry.path)
+                        continue
+                    pending[entry.path] = (sig, since)
+            for path in set(pending) - seen:  # deleted, or given up
+                del pending[path]
+
+            ready.sort()
+            for i in range(0, len(ready), batch_size):
+                batch = ready[i : i + batch_size]
+                rows = stage_batch(batch, calibration)
+                append_table(rows, output)
+                for path in batch:
+                    size, mtime = pending[path][0]
+                    state.write(json.dumps([os.path.basename(path), size, mtime]) + "\n")
+                state.flush()
+                nstaged += len(rows)
+            for path in ready:
+                done[path] = pending.pop(path)[0]
+
+            if once and not pending:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        state.close()
+    print(f"{nstaged} limbs staged and appended to {output}")
+    return nstaged
+
 
-    settings.default_font = "Calco"
-    settings.use_depth_peeling = sys_platform != "Darwin"
+#####################################################################
+if __name__ == "__main__":
 
     # only for calibration:
     # generate_calibration_welsh()
     # plot_stats()
 
+    parser = argparse.ArgumentParser(description=_version)
+    parser.add_argument("inputs", nargs="+",
+                        help="image or txt file; for batch mode also directories, globs or @filelist")
+    parser.add_argument("-o", "--output", default="",
+                        help="batch mode: write one row per limb to this .csv or .parquet file")
+    parser.add_argument("--no-gui", action="store_true",
+                        help="stage txt files without opening any window")
+    parser.add_argument("--watch", action="store_true",
+                        help="stage new txt files as they appear in the given directory,"
+                             " appending to the -o csv file (default <dir>/staging_results.csv)")
+    parser.add_argument("--interval", type=float, default=2.0,
+                        help="watch mode: seconds between two scans of the directory")
+    parser.add_argument("--timings", default="",
+                        help="batch mode: save per-stage timings and failure reasons to this .json file")
+    parser.add_argument("--bootstrap", type=int, default=0,
+                        help="batch mode: add the 95%% age interval of this many perturbed replicates per limb")
+    parser.add_argument("--live", action="store_true",
+                        help="image input: show age, chi2, peaks and valleys while clicking (see live.py)")
+    parser.add_argument("--auto", action="store_true",
+                        help="image input: start from the automatically extracted outline (see outline.py)")
+    parser.add_argument("--max-size", type=int, default=2048,
+                        help="image input: larger images are shown downsampled to about this many pixels")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="image input: do not cache the downsampled image on disk (see pyramid.py)")
+    args = parser.parse_args()
+
+    if args.watch:
+        directory = args.inputs[0]
+        if not os.path.isdir(directory):
+            print(f"\n{directory} is not a directory.\n")
+            exit(0)
+        output = args.output or os.path.join(directory, "staging_results.csv")
+        if not output.lower().endswith(".csv"):
+            print("\nWatch mode appends to a .csv file, please use -o results.csv\n")
+            exit(0)
+        watch_directory(directory, output, interval=args.interval)
+        exit(0)
+
+    batch_mode = (
+        args.no_gui
+        or args.output
+        or len(args.inputs) > 1
+        or not os.path.isfile(args.inputs[0])
+    )
+    if batch_mode:
+        filenames = collect_inputs(args.inputs)
+        if not filenames:
+            print("\nNo txt files with MEASURED points found.\n")
+            exit(0)
+        if args.timings:
+            with Instrument() as ins:
+                rows = stage_batch(filenames, bootstrap=args.bootstrap)
+            print(ins.report())
+            print(f"Timings saved to {ins.save(args.timings)}")
+        else:
+            rows = stage_batch(filenames, bootstrap=args.bootstrap)
+        if args.output:
+            write_table(rows, args.output)
+        else:
+            for row in rows:
+                print(f"{row['name']}  {row['age_string']} :pm{row['sigma']}h"
+                      f"  ({row['age']}h)  chi2={row['chi2']:.3g}  {row['status']}"
+                      + (f"  95% [{row['age_low']:.0f}, {row['age_high']:.0f}]h" if args.bootstrap else ""))
+        exit(0)
+
     if len(sys.argv):
+        from vedo import settings, sys_platform, Image, Text2D
+        from vedo.applications import SplinePlotter
+        from pyramid import ImagePyramid, CACHE_DIR
+
+        settings.default_font = "Calco"
+        settings.use_depth_peeling = sys_platform != "Darwin"
         settings.window_splitting_position = 0.5
         settings.enable_default_mouse_callbacks = False
 
-        filename = sys.argv[1]
+        filename = args.inputs[0]
         if not os.path.isfile(filename):
             print("\nPlease use an image or txt file as argument.\n")
             exit(0)
@@ -386,7 +812,15 @@ if __name__ == "__main__":
             predict(datapoints, embryoname=name)
         else:
             try:
-                pic = Image(filename, channels=(0, 1, 2))
+                # large microscope images are shown downsampled, clicks are mapped back
+                pyramid = ImagePyramid(filename, cachedir=None if args.no_cache else CACHE_DIR)
+                level = pyramid.level_for(args.max_size)
+                if level:
+                    print(f"Showing the {pyramid.size[0]}x{pyramid.size[1]} image"
+                          f" reduced {2 ** level} times, points are saved at full resolution")
+                    pic = Image(np.asarray(pyramid.level(level)))
+                else:
+                    pic = Image(filename, channels=(0, 1, 2))
             except:
                 print("\nPlease use a valid image or txt file with points coords.\n")
                 exit(0)
@@ -398,11 +832,22 @@ if __name__ == "__main__":
             t+= "Press q to proceed"
             instrucs = Text2D(t, pos="bottom-left", c="k1", bg="g9", font="Quikhand", alpha=0.5)
 
+            if args.live:
+                from live import LiveSplinePlotter as SplinePlotter
             plt = SplinePlotter(pic, size=(1200, 1000), title="Welsh Mouse Staging System")
             plt.mode = 'image'
             plt.verbose = False
+            if args.auto:  # clicking now corrects the extracted outline
+                from outline import extract_outline
+                auto_points = extract_outline(pyramid.level(level) if level else filename)
+                if len(auto_points):
+                    plt.points(list(auto_points))
+                else:
+                    print("Could not extract the outline automatically, please click the points")
             plt.start()
             datapoints = plt.points()
+            if level and len(datapoints):
+                datapoints = pyramid.to_full(datapoints, level)
             # plt.close() # close the picture window
 
             if len(datapoints) > 5:
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parameter sweep of the descriptor and calibration constants.
+
+Evaluates a grid, or a random subset of it, of
+  - res: number of points of the resampled outline
+  - n_peaks, n_valleys, distance: the peaks and valleys of find_extrema()
+  - smooth: smoothing of the calibration spline
+  - table: the step/age calibration table (ids/agegroups)
+  - sigma_factor: radius of the heuristic sigma, in units of the distance to the curve
+over the staged training limbs. For every configuration the calibration is
+rebuilt from the descriptors of the limbs, presampled to 200 points as
+calibrate.py does, and the limbs are staged against it as stage_many() does. Reported are the mean absolute error with
+respect to the nominal age in the file name, the failure rate and how often
+the nominal age falls within sigma (in-sample: the limbs are also the
+training set).
+
+Outlines are resampled once per res, both sets of descriptors once per
+(res, n_peaks, n_valleys, distance) and each of these groups is evaluated,
+with all its calibrations, in a separate process.
+
+Usage:
+    python sweep.py data/staged_welsh_reduced/ --distance 15 20 25 --smooth 0.05 0.1 0.2
+    python sweep.py data/staged_welsh_reduced/ --n-peaks 4 5 6 --res 150 200 300 --random 20
+    python sweep.py data/staged_welsh_reduced/ --tables tables.json -o sweep.csv
+where tables.json is like {"shifted": {"ids": [0, 6, ...], "agegroups": [318, 324, ...]}}
+"""
+import os
+import csv
+import json
+import time
+import argparse
+import itertools
+from glob import glob
+import numpy as np
+from utils import Limb, parallel_map
+from limbshape import resample_outlines, descriptors_from_outlines
+from calibration import Calibration
+from calibrate import mls_1d, calibration_curve, CALIBRATION_IDS, CALIBRATION_AGEGROUPS
+
+DEFAULTS = dict(res=200, n_peaks=5, n_valleys=6, distance=20, smooth=0.1, table="default", sigma_factor=1.2)
+METRICS = ["staged", "failure_rate", "mae", "rmse", "bias", "max_error", "coverage", "mean_sigma"]
+
+
+#################################################################################
+def load_training(source):
+    """Measured points and nominal ages of the limbs in a directory (or list of files)."""
+    filenames = sorted(glob(os.path.join(source, "*.txt")) if isinstance(source, str) else source)
+    limbs = [Limb(f, author="welsh") for f in filenames]
+    return [limb.datapoints for limb in limbs], np.array([limb.age for limb in limbs])
+
+
+def make_configs(grid, random=0, seed=0):
+    """All the combinations of the values in grid, or a random subset of them."""
+    keys = list(grid)
+    configs = [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+    if 0 < random < len(configs):
+        pick = np.random.default_rng(seed).choice(len(configs), random, replace=False)
+        configs = [configs[i] for i in sorted(pick)]
+    return configs
+
+
+def age_metrics(ages, nominal, sigma, nlimbs):
+    """Error metrics in hours of the staged limbs, failures count in failure_rate."""
+    if not len(ages):
+        return dict(staged=0, failure_rate=1.0, mae=np.nan, rmse=np.nan, bias=np.nan,
+                    max_error=np.nan, coverage=np.nan, mean_sigma=np.nan)
+    err = ages - nominal
+    return dict(
+        staged=len(ages),
+        failure_rate=1 - len(ages) / nlimbs,
+        mae=float(np.abs(err).mean()),
+        rmse=float(np.sqrt((err ** 2).mean())),
+        bias=float(err.mean()),
+        max_error=float(np.abs(err).max()),
+        coverage=float((np.abs(err) <= sigma).mean()),
+        mean_sigma=float(sigma.mean()),
+    )
+
+
+def _evaluate_group(job):
+    # runs in a worker: one set of descriptors, all the calibrations built on it
+    cal_outlines, stage_outlines, nominal, extrema, configs, tables = job
+    cal_results = descriptors_from_outlines(*cal_outlines, **extrema)
+    results = descriptors_from_outlines(*stage_outlines, **extrema)
+    good = results[:, 0] != 0
+    rows = []
+    if (cal_results[:, 0] != 0).sum() < 5:  # not enough limbs to build a calibration
+        return [dict(cfg, **age_metrics([], [], [], len(nominal))) for cfg in configs]
+    cloud = mls_1d(mls_1d(cal_results[cal_results[:, 0] != 0])[0])[0]  # the two smoothing passes
+    calibrations = {}
+    for cfg in configs:
+        key = (cfg["smooth"], cfg["table"])
+        if key not in calibrations:
+            ids, agegroups = tables[cfg["table"]]
+            calibrations[key] = Calibration.from_arrays(*calibration_curve(cloud, cfg["smooth"], ids, agegroups))
+        res = calibrations[key].lookup_many(results[good], cfg["sigma_factor"])
+        rows.append(dict(cfg, **age_metrics(res["age"], nominal[good], res["sigma"], len(nominal))))
+    return rows
+
+
+def sweep(datapoints_list, nominal, configs, tables=None, workers=None):
+    """Evaluate the configurations (dicts with all the keys of DEFAULTS) on the
+    limbs, one row of parameters and metrics per configuration, sorted by MAE.
+    tables maps the table names used in configs to (ids, agegroups)."""
+    tables = dict(default=(CALIBRATION_IDS, CALIBRATION_AGEGROUPS), **(tables or {}))
+    nominal = np.asarray(nominal)
+    groups = {}
+    for cfg in configs:
+        key = tuple(cfg[k] for k in ("res", "n_peaks", "n_valleys", "distance"))
+        groups.setdefault(key, []).append(cfg)
+
+    # the calibration is built from outlines presampled to 200 points
+    # (training_descriptors(presample=True)), limbs are staged from the clicked points
+    presampled, pre_ok = resample_outlines(datapoints_list, res=200)
+    presampled = [o if k else [] for o, k in zip(presampled, pre_ok)]
+    cal_outlines, stage_outlines = {}, {}
+    for res in sorted(set(cfg["res"] for cfg in configs)):
+        cal_outlines[res] = resample_outlines(presampled, res=res)
+        stage_outlines[res] = resample_outlines(datapoints_list, res=res)
+    jobs = []
+    for (res, n_peaks, n_valleys, distance), cfgs in groups.items():
+        extrema = dict(n_peaks=n_peaks, n_valleys=n_valleys, distance=distance)
+        jobs.append((cal_outlines[res], stage_outlines[res], nominal, extrema, cfgs, tables))
+    rows = [row for rows in parallel_map(_evaluate_group, jobs, workers=workers, chunksize=1) for row in rows]
+    return sorted(rows, key=lambda r: (np.isnan(r["mae"]), r["mae"]))
+
+
+def write_results(rows, filename):
+    columns = list(DEFAULTS) + METRICS
+    with open(filename, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({k: row[k] for k in columns})
+    print(f"Results of {len(rows)} configurations saved to {filename}")
+
+
+def print_results(rows, top=10):
+    header = "".join(f"{k:>13}" for k in list(DEFAULTS) + ["mae h", "failed %", "coverage %"])
+    print(header)
+    for row in rows[:top]:
+        cells = [f"{row[k]:>13}" for k in DEFAULTS]
+        cells += [f"{row['mae']:13.2f}", f"{100 * row['failure_rate']:13.1f}", f"{100 * row['coverage']:13.1f}"]
+        print("".join(cells) + ("   <- current" if all(row[k] == v for k, v in DEFAULTS.items()) else ""))
+
+
+#################################################################################
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="welsh_stager parameter sweep")
+    parser.add_argument("source", help="directory of staged limb .txt files")
+    parser.add_argument("-o", "--output", default="sweep.csv", help="csv file of the results")
+    parser.add_argument("--res", type=int, nargs="+", default=[DEFAULTS["res"]])
+    parser.add_argument("--n-peaks", type=int, nargs="+", default=[DEFAULTS["n_peaks"]])
+    parser.add_argument("--n-valleys", type=int, nargs="+", default=[DEFAULTS["n_valleys"]])
+    parser.add_argument("--distance", type=int, nargs="+", default=[DEFAULTS["distance"]])
+    parser.add_argument("--smooth", type=float, nargs="+", default=[DEFAULTS["smooth"]])
+    parser.add_argument("--sigma-factor", type=float, nargs="+", default=[DEFAULTS["sigma_factor"]])
+    parser.add_argument("--tables", default="", help="json file of named ids/agegroups tables to try")
+    parser.add_argument("--random", type=int, default=0, help="evaluate only this many random configurations")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    tables = {}
+    if args.tables:
+        with open(args.tables) as f:
+            tables = {k: (np.array(v["ids"]), np.array(v["agegroups"])) for k, v in json.load(f).items()}
+    grid = dict(
+        res=args.res,
+        n_peaks=args.n_peaks,
+        n_valleys=args.n_valleys,
+        distance=args.distance,
+        smooth=args.smooth,
+        table=["default"] + list(tables),
+        sigma_factor=args.sigma_factor,
+    )
+    configs = make_configs(grid, args.random, args.seed)
+
+    t0 = time.perf_counter()
+    datapoints_list, nominal = load_training(args.source)
+    print(f"{len(datapoints_list)} limbs, {len(configs)} configurations")
+    rows = sweep(datapoints_list, nominal, configs, tables, workers=args.workers)
+    print_results(rows)
+    write_results(rows, args.output)
+    print(f"Sweep done in {time.perf_counter() - t0:.1f}s")
@@ -0,0 +1,14 @@
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SAMPLE = os.path.join(ROOT, "pics", "E14.5_L3-03_HL2.5X_LHL.txt")
+
+
+@pytest.fixture(autouse=True)
+def in_repo_root(monkeypatch):
+    # the calibration files are found relative to the repository root
+    monkeypatch.chdir(ROOT)
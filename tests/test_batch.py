@@ -0,0 +1,23 @@
+import shutil
+from conftest import SAMPLE
+from instrument import Instrument
+from stager import stage_batch
+
+
+def test_status_counts_match_rows(tmp_path):
+    shutil.copy(SAMPLE, tmp_path / "a.txt")
+    (tmp_path / "empty.txt").write_text("")
+    (tmp_path / "bad.txt").write_text("MEASURED\n1 2\nx y\n")
+    (tmp_path / "binary.txt").write_bytes(b"\xff\xfe\x00MEASURED")
+    files = sorted(str(p) for p in tmp_path.iterdir())
+    with Instrument() as ins:
+        rows = stage_batch(files, verbose=False)
+
+    statuses = {}
+    for row in rows:
+        statuses[row["status"]] = statuses.get(row["status"], 0) + 1
+    assert {k: v for k, v in ins.counts.items() if k.startswith("status ")} == {
+        f"status {k}": v for k, v in statuses.items()
+    }
+    assert statuses["ok"] == 1
+    assert ins.failures == []  # unreadable and empty files are not spline failures
@@ -0,0 +1,33 @@
+import shutil
+import numpy as np
+from conftest import SAMPLE
+from utils import read_measured_points
+from stager import write_measured_points
+from calibrate import CalibrationBuilder
+
+
+def _write_limbs(directory, n=30, seed=0):
+    base = read_measured_points(SAMPLE)
+    rng = np.random.default_rng(seed)
+    for i in range(n):
+        pts = base.copy()
+        pts[:, :2] += rng.normal(0, 6, (len(pts), 2))
+        write_measured_points(str(directory / f"E14.{i % 4 * 25:02d}_L{i}-01_LHL.txt"), pts)
+
+
+def test_incremental_update_with_duplicate_file(tmp_path):
+    _write_limbs(tmp_path)
+    builder = CalibrationBuilder()
+    builder.update(str(tmp_path), workers=1)
+    builder.build()
+
+    shutil.copy(tmp_path / "E14.00_L0-01_LHL.txt", tmp_path / "E14.00_L0-01_LHL_copy.txt")
+    assert builder.update(str(tmp_path), workers=1) == (1, 0)
+    builder.build()
+
+    full = CalibrationBuilder()
+    full.update(str(tmp_path), workers=1)
+    full.build()
+    for k in range(2):
+        assert np.allclose(builder._mls[k][0], full._mls[k][0])
+    assert np.allclose(builder.spline, full.spline)
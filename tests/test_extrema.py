@@ -0,0 +1,32 @@
+import numpy as np
+from scipy import signal
+from utils import extrema_rows
+
+
+def _plateau_profiles(n, seed=0, length=200):
+    # random walks held constant for 1-4 samples, so that peaks are often flat
+    rng = np.random.default_rng(seed)
+    out = np.empty((n, length))
+    for i in range(n):
+        steps = np.cumsum(rng.normal(0, 1, length))
+        out[i] = np.repeat(steps, rng.integers(1, 5, length))[:length]
+    return out
+
+
+def test_batch_equals_single_with_ties():
+    y = np.round(_plateau_profiles(500) / 3)  # many peaks of exactly equal height
+    batch = extrema_rows(y, 5, 6, 20)
+    for i in range(len(y)):
+        single = extrema_rows(y[i : i + 1], 5, 6, 20)
+        for b, s in zip(batch, single):
+            assert np.array_equal(b[i], s[0])
+
+
+def test_same_as_find_peaks():
+    y = _plateau_profiles(300, seed=1)
+    peak_ids, peak_mask, valley_ids, valley_mask = extrema_rows(y, 5, 6, 20)
+    for i in range(len(y)):
+        for sign, ids, mask, n in ((1, peak_ids, peak_mask, 5), (-1, valley_ids, valley_mask, 6)):
+            found = signal.find_peaks(sign * y[i], distance=20)[0]
+            largest = np.sort(found[np.argsort(y[i][found])[::-1][:n]])
+            assert np.array_equal(ids[i][mask[i]], largest)
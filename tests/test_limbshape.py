@@ -0,0 +1,27 @@
+import numpy as np
+from limbshape import fit_circle_2d, fit_circles_2d
+
+
+def test_degenerate_circle_fits_fail():
+    # pairs of points and points on a line, where rounding used to give a circle
+    rng = np.random.default_rng(0)
+    t = rng.normal(0, 1, (50, 3, 1))
+    degenerate = [rng.normal(0, 1, (2, 2)) for _ in range(50)]
+    degenerate += list(rng.normal(0, 1, (50, 1, 2)) + t * [0.3, 0.7])
+    for p in degenerate:
+        assert fit_circle_2d(p)[1] == 0
+
+    points = np.zeros((len(degenerate), 3, 2))
+    mask = np.zeros((len(degenerate), 3), dtype=bool)
+    for i, p in enumerate(degenerate):
+        points[i, : len(p)] = p
+        mask[i, : len(p)] = True
+    assert (fit_circles_2d(points, mask)[1] == 0).all()
+
+
+def test_circle_fit():
+    arc = [[2.0, 1.0], [1.0, 2.0], [0.0, 1.0], [1.0 + np.sqrt(0.5), 1.0 - np.sqrt(0.5)]]
+    center, r = fit_circle_2d(arc)
+    assert np.allclose(center, [1, 1]) and np.isclose(r, 1)
+    centers, radii = fit_circles_2d(np.array([arc]), np.ones((1, 4), dtype=bool))
+    assert np.allclose(centers[0], [1, 1]) and np.isclose(radii[0], 1)
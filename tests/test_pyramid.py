@@ -0,0 +1,35 @@
+import os
+import numpy as np
+import pytest
+from PIL import Image
+from pyramid import ImagePyramid, prune_cache
+
+
+def _image(path, size=(120, 80)):
+    rng = np.random.default_rng(0)
+    Image.fromarray(rng.integers(0, 255, (size[1], size[0], 3), dtype=np.uint8)).save(path)
+    return str(path)
+
+
+def test_pixel_limit_raised_only_for_the_pyramid(tmp_path, monkeypatch):
+    filename = _image(tmp_path / "scan.png")
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    with pytest.raises(Image.DecompressionBombError):
+        Image.open(filename)
+    pyr = ImagePyramid(filename, cachedir=None)
+    assert pyr.level(1).shape == (40, 60, 3)
+    assert Image.MAX_IMAGE_PIXELS == 1000
+
+
+def test_cache_is_bounded(tmp_path):
+    cachedir = str(tmp_path / "cache")
+    for i in range(4):
+        pyr = ImagePyramid(_image(tmp_path / f"scan{i}.png"), cachedir=cachedir)
+        pyr.level(1)
+    files = [os.path.join(cachedir, f) for f in os.listdir(cachedir)]
+    assert len(files) == 4
+    size = os.path.getsize(files[0])
+    newest = max(files, key=os.path.getmtime)
+    prune_cache(cachedir, max_bytes=2 * size)
+    left = [os.path.join(cachedir, f) for f in os.listdir(cachedir)]
+    assert len(left) == 2 and newest in left
@@ -0,0 +1,13 @@
+import asyncio
+import json
+import pytest
+from server import StagingServer, RequestError
+
+
+@pytest.mark.parametrize("bootstrap", [True, False, -1, 1.5, "10", 10**9])
+def test_bad_bootstrap_is_rejected(bootstrap):
+    server = StagingServer(workers=1)
+    body = json.dumps({"points": [[0, 0], [1, 0], [1, 1]], "bootstrap": bootstrap}).encode()
+    with pytest.raises(RequestError) as e:
+        asyncio.run(server.route("POST", "/predict", body))
+    assert e.value.status == 400
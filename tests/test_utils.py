@@ -0,0 +1,15 @@
+import numpy as np
+from conftest import SAMPLE
+from utils import read_limb_files, read_measured_points
+
+
+def test_bad_result_line_keeps_points(tmp_path):
+    with open(SAMPLE) as f:
+        text = f.read()
+    bad = tmp_path / "E14.5_L3-03_LHL.txt"
+    bad.write_text("\n".join("RESULT garbled" if l.startswith("RESULT") else l for l in text.split("\n")))
+
+    limbs = read_limb_files(str(bad), split=False)
+    assert limbs.meta["ok"][0]
+    assert np.isnan(limbs.meta["fit_age"][0])
+    assert np.array_equal(read_measured_points(str(bad)), read_measured_points(SAMPLE))
@@ -0,0 +1,16 @@
+import csv
+import shutil
+from conftest import SAMPLE
+from stager import watch_directory
+
+
+def test_watch_skips_its_own_output(tmp_path):
+    for name in ("a.txt", "b.txt"):
+        shutil.copy(SAMPLE, tmp_path / name)
+    output = tmp_path / "staging_results.csv"
+    for _ in range(2):  # the second pass finds the state file written by the first
+        watch_directory(str(tmp_path), str(output), interval=0.05, settle=0, once=True)
+    with open(output, newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert sorted(r["name"] for r in rows) == ["a.txt", "b.txt"]
+    assert all(r["status"] == "ok" for r in rows)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Monte-Carlo estimate of the staging uncertainty.
+
+The measured points of a limb are perturbed many times, as if the outline
+had been clicked again: every point slides along the outline, is jittered
+and some points are dropped. All the replicates of all the limbs are staged
+together with descriptors_batch() and lookup_many(), giving for each limb an
+empirical distribution of ages and its intervals, in place of the heuristic
+sigma of Calibration.lookup().
+
+    from uncertainty import bootstrap_stage
+    res = bootstrap_stage(datapoints, n=200)
+    print(res["median"], res["interval95"])
+
+Usage:
+    python uncertainty.py pics/E14.5_L3-03_HL2.5X_LHL.txt -n 500
+"""
+import time
+import argparse
+import numpy as np
+from scipy.spatial import cKDTree
+from calibration import get_calibration
+from limbshape import resample_outline, descriptors_batch
+from instrument import current, paused
+
+BOOTSTRAP_COLUMNS = ["age_median", "age_low", "age_high", "age_std", "replicates_ok"]
+
+
+#################################################################################
+def perturb_outline(datapoints, n=200, jitter=0.2, dropout=0.1, slide=0.5, rng=None):
+    """n perturbed copies of the outline, as a list of (k, 3) arrays.
+
+    jitter is the standard deviation of the gaussian noise and slide the
+    range of the uniform shift of each point along the outline, both in units
+    of the mean distance between consecutive points. dropout is the probability
+    of removing a point, the two end points are always kept (they set where the
+    outline is cut) and do not slide."""
+    rng = np.random.default_rng(rng)
+    points = np.asarray(datapoints, dtype=float)[:, :2]
+    k = len(points)
+    spacing = np.mean(np.linalg.norm(np.diff(points, axis=0), axis=1))
+
+    if slide:
+        # arc length of the points along a dense spline through them
+        dense = resample_outline(points, res=20 * k)[:, :2]
+        sdense = np.r_[0, np.cumsum(np.linalg.norm(np.diff(dense, axis=0), axis=1))]
+        nearest = cKDTree(dense).query(points)[1]
+        s = np.maximum.accumulate(sdense[nearest])
+        shifts = rng.uniform(-slide / 2, slide / 2, (n, k)) * spacing
+        shifts[:, [0, -1]] = 0
+        snew = np.sort(np.clip(s + shifts, 0, sdense[-1]), axis=1)
+        reps = np.stack([np.interp(snew, sdense, dense[:, 0]), np.interp(snew, sdense, dense[:, 1])], axis=-1)
+    else:
+        reps = np.repeat(points[None], n, axis=0)
+    if jitter:
+        reps += rng.normal(0, jitter * spacing, reps.shape)
+    reps = np.concatenate([reps, np.zeros((n, k, 1))], axis=-1)
+
+    keep = rng.random((n, k)) >= dropout
+    keep[:, [0, -1]] = True
+    return [rep[kp] for rep, kp in zip(reps, keep)]
+
+
+def summarize_ages(ages):
+    """Empirical distribution of the ages of the replicates of one limb."""
+    ages = np.asarray(ages)
+    if not len(ages):
+        return dict(replicates_ok=0, mean=0.0, std=0.0, median=0.0,
+                    interval68=(0.0, 0.0), interval95=(0.0, 0.0), histogram={})
+    values, counts = np.unique(ages, return_counts=True)
+    return dict(
+        replicates_ok=len(ages),
+        mean=float(ages.mean()),
+        std=float(ages.std()),
+        median=float(np.median(ages)),
+        interval68=tuple(float(a) for a in np.percentile(ages, [16, 84])),
+        interval95=tuple(float(a) for a in np.percentile(ages, [2.5, 97.5])),
+        histogram={int(v): int(c) for v, c in zip(values, counts)},
+    )
+
+
+def bootstrap_many(datapoints_list, n=200, calibration=None, seed=0, max_rows=20000, **perturbation):
+    """Perturb and stage n replicates of every limb, one summary dict per limb
+    (see summarize_ages). Replicates of many limbs are staged in the same batch,
+    up to max_rows replicates at a time. Keyword arguments go to perturb_outline()."""
+    if calibration is None:
+        calibration = get_calibration()
+    ins = current()
+    rng = np.random.default_rng(seed)
+    summaries = [summarize_ages([]) for _ in datapoints_list]
+    todo = [i for i, dp in enumerate(datapoints_list) if len(dp) > 5]
+    step = max(1, max_rows // n)
+    for j in range(0, len(todo), step):
+        ids = todo[j : j + step]
+        with ins.timer("bootstrap perturb"):
+            replicates = []
+            for i in ids:
+                replicates += perturb_outline(datapoints_list[i], n, rng=rng, **perturbation)
+        with ins.timer("bootstrap descriptors"), paused():
+            results = descriptors_batch(replicates).reshape(len(ids), n, 3)
+        with ins.timer("bootstrap lookup"):
+            ages = calibration.lookup_many(results.reshape(-1, 3))["age"].reshape(len(ids), n)
+        ok = results[..., 0] != 0
+        ins.count("bootstrap replicates", ok.size)
+        ins.count("bootstrap replicates failed", int((~ok).sum()))
+        for r, i in enumerate(ids):
+            summaries[i] = summarize_ages(ages[r][ok[r]])
+    return summaries
+
+
+def bootstrap_stage(datapoints, n=200, calibration=None, seed=0, **perturbation):
+    """Age distribution of a single limb, see bootstrap_many()."""
+    return bootstrap_many([datapoints], n, calibration, seed, **perturbation)[0]
+
+
+def bootstrap_columns(summary):
+    """The summary as the extra columns of a staging result row."""
+    return dict(
+        age_median=summary["median"],
+        age_low=summary["interval95"][0],
+        age_high=summary["interval95"][1],
+        age_std=summary["std"],
+        replicates_ok=summary["replicates_ok"],
+    )
+
+
+#################################################################################
+if __name__ == "__main__":
+
+    from utils import read_measured_points, age_as_string
+    from stager import stage
+
+    parser = argparse.ArgumentParser(description="welsh_stager Monte-Carlo uncertainty")
+    parser.add_argument("inputs", nargs="+", help="txt files with MEASURED points")
+    parser.add_argument("-n", type=int, default=200, help="number of replicates per limb")
+    parser.add_argument("--jitter", type=float, default=0.2, help="in units of the point spacing")
+    parser.add_argument("--dropout", type=float, default=0.1, help="probability of dropping a point")
+    parser.add_argument("--slide", type=float, default=0.5, help="in units of the point spacing")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    limbs = [read_measured_points(f) for f in args.inputs]
+    t0 = time.perf_counter()
+    summaries = bootstrap_many(
+        limbs, args.n, seed=args.seed, jitter=args.jitter, dropout=args.dropout, slide=args.slide
+    )
+    elapsed = time.perf_counter() - t0
+    for filename, datapoints, s in zip(args.inputs, limbs, summaries):
+        row = stage(datapoints)
+        print(f"{filename}: {row['age_string']} ({row['age']}h :pm{row['sigma']}h heuristic)")
+        if not s["replicates_ok"]:
+            print("  no replicate could be staged")
+            continue
+        lo, hi = s["interval95"]
+        print(f"  median {age_as_string(s['median'])} ({s['median']:.0f}h), std {s['std']:.1f}h,"
+              f" 68% [{s['interval68'][0]:.0f}, {s['interval68'][1]:.0f}]h,"
+              f" 95% [{lo:.0f}, {hi:.0f}]h, {s['replicates_ok']}/{args.n} replicates staged")
+        print("  " + "  ".join(f"{a}h:{c}" for a, c in s["histogram"].items()))
+    print(f"{len(limbs) * args.n} replicates in {elapsed:.2f}s")
@@ -1,13 +1,132 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import os
+import re
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from vedo.utils import sort_by_column
-from scipy import signal
 
 
 #################################################################################
+# welsh filenames start with e.g. E14.25_L3-03_..., the fraction of day gives the hour
+_WELSH_NAME_RE = re.compile(r"E(1[34])\.(0|25|5|75)_?([^_E]+)(?:_|$)")
+_WELSH_HOURS = {"0": "00", "25": "06", "5": "12", "75": "18"}
+
+LIMB_NAME_DTYPE = np.dtype(
+    [
+        ("day", "i2"),
+        ("hour", "i2"),
+        ("age", "i4"),
+        ("age_as_string", "U8"),
+        ("litterID", "U16"),
+        ("embryoID", "U16"),
+    ]
+)
+
+
+def _parse_welsh_name(name):
+    m = _WELSH_NAME_RE.match(name)
+    if m:
+        hh = _WELSH_HOURS[m.group(2)]
+        return [int(m.group(1)), int(hh), f"E{m.group(1)}.{hh}", m.group(3), ""]
+
+    # general case, not in the usual format E...
+    day, hour, age_as_string, litterID = 0, 0, "", ""
+    sfn = name
+    for d in ("13", "14"):
+        for frac, hh in _WELSH_HOURS.items():
+            sfn = sfn.replace(f"E{d}.{frac}", f"E{d};{hh}_")
+    sfn = sfn.replace("__", "_").split("_")
+    try:
+        day = int(sfn[0].split(";")[0].replace("E", ""))
+        hour = int(sfn[0].split(";")[1])
+        age_as_string = "E" + str(day) + "." + sfn[0].split(";")[1]
+        litterID = sfn[1]
+    except (ValueError, IndexError):
+        pass
+    return [day, hour, age_as_string, litterID, ""]
+
+
+def parse_limb_name(name, author="welsh"):
+    """Return day, hour, age_as_string, litterID, embryoID and age (in hours)
+    encoded in a limb filename, following the naming convention of the author."""
+    if author == "heura":
+        sfn = name.split(".")
+        day = int(sfn[0].replace("E", ""))
+        hour = int(sfn[1].split("_")[0])
+        meta = [day, hour, str(day) + "." + sfn[1].split("_")[0], sfn[1].split("_")[1], ""]
+    elif author == "welsh":
+        meta = _parse_welsh_name(name)
+    else:
+        sfn = name.split("_")
+        day = int(sfn[0].split(";")[0].replace("E", ""))
+        hour = int(sfn[0].split(";")[1])
+        meta = [day, hour, "E" + str(day) + "." + sfn[0].split(";")[1], sfn[1], sfn[2]]
+    return meta + [24 * meta[0] + meta[1]]
+
+
+def parse_limb_names(names, author="welsh"):
+    """Parse many limb filenames at once into a structured array (see LIMB_NAME_DTYPE)."""
+    out = np.zeros(len(names), dtype=LIMB_NAME_DTYPE)
+    for i, name in enumerate(names):
+        day, hour, age_as_string, litterID, embryoID, age = parse_limb_name(
+            os.path.basename(name), author
+        )
+        out[i] = (day, hour, age, age_as_string, litterID, embryoID)
+    return out
+
+
+def _name_property(i, doc):
+    # attribute parsed from the filename on first access, can also be assigned
+    def fget(self):
+        return self._parsed_name()[i]
+
+    def fset(self, value):
+        self._parsed_name()[i] = value
+
+    return property(fget, fset, doc=doc)
+
+
 class Limb:
+    """A limb outline read from a txt file.
+
+    Attributes live in __slots__ to keep many limbs in memory. The day, hour,
+    age_as_string, litterID, embryoID and age encoded in the filename are
+    parsed on first access (see parse_limb_name).
+    """
+
+    __slots__ = (
+        "author",
+        "datapoints",
+        "side",
+        "name",
+        "filename",
+        "extra_scale_factor",
+        "fit_points",
+        "fit_age",
+        "fit_error",
+        "fit_chi2",
+        "fit_delta_length",
+        "_name_meta",
+        # rarely used: unset until assigned, defaults in _DEFAULTS
+        "icp_score",
+        "ageIndex",
+        "age_in_minutes",
+        "age_h_m",
+        "fit_side",
+        "Line",  # holds the actors
+        "LineReg",
+    )
+    _DEFAULTS = dict(
+        icp_score=0, ageIndex=None, age_in_minutes=0, age_h_m=(0, 0), fit_side=0, Line=None, LineReg=None,
+    )
+
+    day = _name_property(0, "day of the embryo age")
+    hour = _name_property(1, "hours after the day")
+    age_as_string = _name_property(2, "age as in the filename, e.g. E14.12")
+    litterID = _name_property(3, "litter identifier")
+    embryoID = _name_property(4, "embryo identifier")
+    age = _name_property(5, "age in hours")
+
     def __init__(self, source="", author="unknown"):
 
         self.author = author.lower()
@@ -15,20 +134,8 @@ class Limb:
         self.side = "U"
         self.name = ""
         self.filename = source
-        self.icp_score = 0
-        self.day = 0
-        self.hour = 0
-        self.age_as_string = ""
-        self.litterID = ""
-        self.embryoID = ""
-        self.age = 0
-        self.ageIndex = None
-        self.age_in_minutes = 0
-        self.age_h_m = (0, 0)
         self.extra_scale_factor = 1
-
-        self.Line = None  # holds the actors
-        self.LineReg = None
+        self._name_meta = None
 
         if self.author == "james":
             self.extra_scale_factor = 4.545  # DO NOT CHANGE, check out scaling_mistake.py
@@ -38,7 +145,6 @@ class Limb:
         self.fit_points = []
         self.fit_error = 0
         self.fit_chi2 = 0
-        self.fit_side = 0
         self.fit_delta_length = 0
 
         if not source:
@@ -53,95 +159,56 @@ class Limb:
         elif "left" in source:
             self.side = "L"
 
-        f = open(source, "r")
-        lines = f.readlines()
-        f.close()
-
+        limbs = read_limb_files(source, split=False)
         self.name = source.split("/")[-1]
-
-        for i in range(len(lines)):
-            if i < 1:
-                continue
-            line = lines[i]
-            if "," in line:
-                line = lines[i].split(",")
-            else:
-                line = lines[i].split()
-
-            if line[0] == "MEASURED":
-                self.datapoints.append([float(line[1]), float(line[2]), 0.0])
-            elif line[0] == "FITSHAPE":
-                self.fit_points.append([float(line[1]), float(line[2]), 0.0])
-            elif line[0] == "RESULT":
-                self.fit_age = float(line[1])
-                self.fit_error = float(line[2])
-                self.fit_chi2 = float(line[3])
-            elif line[0] == "Total":  #  pick "Total lengths different by X per cent"
-                self.fit_delta_length = float(line[4]) / 100.0
-
-        if "MIRRORED" in lines[i]:
+        self.datapoints = limbs.measured_points(0).copy()
+        self.fit_points = limbs.fitshape_points(0).copy()
+        meta = limbs.meta[0]
+        self.fit_age = float(meta["fit_age"])
+        self.fit_error = float(meta["fit_error"])
+        self.fit_chi2 = float(meta["fit_chi2"])
+        self.fit_delta_length = float(meta["fit_delta_length"])
+
+        if meta["mirrored"]:
             if self.side == "R":
                 print("WARNING: staging system detected left but filename contains right", source)
                 self.side == "R"  ### CORRECT IT! (staging sys is very reliable on this)
 
-        self.datapoints = np.array(self.datapoints) * self.extra_scale_factor
+        self.datapoints = self.datapoints * self.extra_scale_factor
 
         if len(self.fit_points):
-            self.fit_points = np.array(self.fit_points) * self.extra_scale_factor
+            self.fit_points = self.fit_points * self.extra_scale_factor
+        else:
+            self.fit_points = []
 
         if self.side == "L":
             self.datapoints[:, 0] *= -1
 
-        if self.author == "heura":
-            sfn = self.name.split(".")
-            self.day = int(sfn[0].replace("E", ""))
-            self.hour = int(sfn[1].split("_")[0])
-            self.age_as_string = str(self.day) + "." + sfn[1].split("_")[0]
-            self.litterID = sfn[1].split("_")[1]
-            self.embryoID = ""
-        elif self.author == "welsh":
-            sfn = self.name
-            sfn = sfn.replace("E13.0", "E13;00_")
-            sfn = sfn.replace("E13.25", "E13;06_")
-            sfn = sfn.replace("E13.5", "E13;12_")
-            sfn = sfn.replace("E13.75", "E13;18_")
-            sfn = sfn.replace("E14.0", "E14;00_")
-            sfn = sfn.replace("E14.25", "E14;06_")
-            sfn = sfn.replace("E14.5", "E14;12_")
-            sfn = sfn.replace("E14.75", "E14;18_")
-            sfn = sfn.replace("__", "_")
-            sfn = sfn.split("_")
-            self.age = 0
-            try:
-                self.day = int(sfn[0].split(";")[0].replace("E", ""))
-                self.hour = int(sfn[0].split(";")[1])
-                self.age_as_string = "E" + str(self.day) + "." + sfn[0].split(";")[1]
-                self.litterID = sfn[1]
-            except:
-                # not in the usual format E...
-                pass
-        else:
-            sfn = self.name.split("_")
-            self.age = 0
-            self.day = int(sfn[0].split(";")[0].replace("E", ""))
-            self.hour = int(sfn[0].split(";")[1])
-            self.age_as_string = "E" + str(self.day) + "." + sfn[0].split(";")[1]
-            self.litterID = sfn[1]
-            self.embryoID = sfn[2]
-
-        self.age = 24 * self.day + self.hour
+    def __getattr__(self, key):
+        # only called for attributes that are not set
+        try:
+            return Limb._DEFAULTS[key]
+        except KeyError:
+            raise AttributeError(f"'Limb' object has no attribute '{key}'") from None
+
+    def _parsed_name(self):
+        if self._name_meta is None:
+            if self.name:
+                self._name_meta = parse_limb_name(self.name, self.author)
+            else:
+                self._name_meta = [0, 0, "", "", "", 0]
+        return self._name_meta
 
 
 #################################################################################
 def load_welsh_limbs(source="data/staged_welsh/"):
+    # source can be a directory of txt files or a binary .limbset file (see limbset.py),
+    # which is memory-mapped: limbs are read only when accessed
     limbs = []
-    if source.endswith(".npy"):
-        llist = np.load(source, allow_pickle=True)
-        for dlimb in llist:
-            if "kevin" not in dlimb["author"]:
-                continue
-            lm = Limb(dlimb)
-            limbs.append(lm)
+    if source.endswith(".limbset"):
+        from limbset import LimbSet
+
+        limbs = LimbSet(source)
     else:
         for fn in sorted(os.listdir(source)):
             if not fn.endswith(".txt"):
@@ -152,25 +219,183 @@ def load_welsh_limbs(source="data/staged_welsh/"):
 
 
 ###############################################
-def read_measured_points(filename):
-    # read txt file points
-
-    with open(filename, "r") as f:
-        lines = f.readlines()
-
-    datapoints = []
-    for i, line in enumerate(lines):
-        if not i:
-            continue
-        if "," in line:
-            line = lines[i].split(",")
-        else:
-            line = lines[i].split()
+_KEYWORDS = ("MEASURED", "FITSHAPE", "RESULT", "Total", "side", "PREDICTED")
+
+LIMB_META_DTYPE = np.dtype(
+    [
+        ("fit_age", "f8"),
+        ("fit_error", "f8"),
+        ("fit_chi2", "f8"),
+        ("fit_delta_length", "f8"),
+        ("mirrored", "?"),
+        ("ok", "?"),
+    ]
+)
+
+
+class LimbArrays:
+    """Points of many limbs stored in contiguous arrays.
+
+    The MEASURED points of limb i are measured[measured_offsets[i]:measured_offsets[i+1]]
+    (CSR-style), likewise for the FITSHAPE points. Per-limb RESULT values and flags
+    are in the structured array meta (see LIMB_META_DTYPE), names and source files in
+    the lists names and sources.
+    """
+
+    def __init__(self, names, sources, measured, measured_offsets, fitshape, fitshape_offsets, meta):
+        self.names = names
+        self.sources = sources
+        self.measured = measured
+        self.measured_offsets = measured_offsets
+        self.fitshape = fitshape
+        self.fitshape_offsets = fitshape_offsets
+        self.meta = meta
+
+    def __len__(self):
+        return len(self.names)
+
+    def measured_points(self, i):
+        return self.measured[self.measured_offsets[i] : self.measured_offsets[i + 1]]
+
+    def fitshape_points(self, i):
+        return self.fitshape[self.fitshape_offsets[i] : self.fitshape_offsets[i + 1]]
+
+
+def _header_count(line):
+    # number of points announced at the end of a header line, None if not given
+    tokens = line.split()
+    return int(tokens[-1]) if tokens and tokens[-1].isdigit() else None
+
+
+def _split_limbs(lines):
+    # a file holds one limb, or several concatenated ones each starting with its
+    # header line (a line not starting with a known keyword) followed by MEASURED points.
+    # A header line only starts a new limb once the current limb has MEASURED points,
+    # all the ones announced by its header if it gives their number: a stray line
+    # inside a limb does not split it.
+    starts = [
+        i for i, l in enumerate(lines[:-1])
+        if i and l and not l.startswith(_KEYWORDS) and lines[i + 1].startswith("MEASURED")
+    ]
+    if not starts:
+        return [lines]
+    measured = np.cumsum([l.startswith("MEASURED") for l in lines])
+    chunks, begin = [], 0
+    for i in starts:
+        count = measured[i - 1] - (measured[begin - 1] if begin else 0)
+        expected = _header_count(lines[begin])
+        if count and (expected is None or count >= expected):
+            chunks.append(lines[begin:i])
+            begin = i
+    chunks.append(lines[begin:])
+    return chunks
+
+
+def _xy_tokens(lines):
+    # x and y strings of "KEYWORD x y" lines, extra columns are ignored
+    tokens = " ".join(lines).split()
+    if len(tokens) == 3 * len(lines):
+        return tokens[1::3], tokens[2::3]
+    tokens = [l.split()[1:3] for l in lines]
+    return [t[0] if t else "" for t in tokens], [t[1] if len(t) > 1 else "" for t in tokens]
+
+
+def _to_points(xs, ys):
+    # convert the x and y strings to an (n, 3) array with one allocation
+    pts = np.zeros((len(xs), 3))
+    try:
+        pts[:, 0] = np.array(xs, dtype=float)
+        pts[:, 1] = np.array(ys, dtype=float)
+    except ValueError:
+        return None
+    return pts
+
+
+def read_limb_files(filenames, fitshape=True, split=True):
+    """Read MEASURED/FITSHAPE points and RESULT metadata of many limb txt files,
+    or of files with several concatenated limbs, into a LimbArrays object.
+    Set fitshape=False to skip the FITSHAPE points when they are not needed,
+    split=False to read each file as a single limb."""
+    if isinstance(filenames, str):
+        filenames = [filenames]
+
+    names, sources, chunks = [], [], []
+    for filename in filenames:
+        with open(filename, "r") as f:
+            lines = f.read().replace(",", " ").split("\n")
+        file_chunks = _split_limbs(lines)
+        if not split and len(file_chunks) > 1:
+            print(f"WARNING: {filename} looks like {len(file_chunks)} concatenated limbs,"
+                  " reading all its points as one limb")
+            file_chunks = [lines]
+        base = os.path.basename(filename)
+        for k, chunk in enumerate(file_chunks):
+            names.append(base if len(file_chunks) == 1 else f"{base}:{k}")
+            sources.append(filename)
+            chunks.append(chunk)
+
+    meta = np.zeros(len(chunks), dtype=LIMB_META_DTYPE)
+    meta["ok"] = True
+    mx, my, fx, fy = [], [], [], []
+    mcounts = np.zeros(len(chunks), dtype=np.int64)
+    fcounts = np.zeros(len(chunks), dtype=np.int64)
+    for i, lines in enumerate(chunks):
+        lines = lines[1:]  # skip the header
+        x, y = _xy_tokens([l for l in lines if l.startswith("MEASURED")])
+        mx += x
+        my += y
+        mcounts[i] = len(x)
+        if fitshape:
+            x, y = _xy_tokens([l for l in lines if l.startswith("FITSHAPE")])
+            fx += x
+            fy += y
+            fcounts[i] = len(x)
+        # a malformed RESULT or Total line leaves its values NaN, "ok" is about the points only
+        for l in lines:
+            if l.startswith("RESULT"):
+                try:
+                    t = l.split()
+                    meta[i]["fit_age"], meta[i]["fit_error"], meta[i]["fit_chi2"] = map(float, t[1:4])
+                except ValueError:  # also fewer than 3 values
+                    meta[i]["fit_age"] = meta[i]["fit_error"] = meta[i]["fit_chi2"] = np.nan
+            elif l.startswith("Total"):  # pick "Total lengths different by X per cent"
+                try:
+                    meta[i]["fit_delta_length"] = float(l.split()[4]) / 100.0
+                except (ValueError, IndexError):
+                    meta[i]["fit_delta_length"] = np.nan
+        lastline = [l for l in lines[-2:] if l.strip()]
+        meta[i]["mirrored"] = bool(lastline) and "MIRRORED" in lastline[-1]
+
+    measured = _to_points(mx, my)
+    fitshape = _to_points(fx, fy)
+    if measured is None or fitshape is None:
+        # some limb has a malformed number: convert limb by limb and empty the bad ones
+        measured, mcounts = _convert_per_limb(mx, my, mcounts, meta)
+        fitshape, fcounts = _convert_per_limb(fx, fy, fcounts, meta)
+    measured_offsets = np.r_[0, np.cumsum(mcounts)]
+    fitshape_offsets = np.r_[0, np.cumsum(fcounts)]
+    return LimbArrays(names, sources, measured, measured_offsets, fitshape, fitshape_offsets, meta)
+
+
+def _convert_per_limb(xs, ys, counts, meta):
+    arrays, start = [], 0
+    for i, n in enumerate(counts):
+        pts = _to_points(xs[start : start + n], ys[start : start + n])
+        start += n
+        if pts is None:
+            meta[i]["ok"] = False
+            pts = np.zeros((0, 3))
+        arrays.append(pts)
+    counts = np.array([len(a) for a in arrays], dtype=np.int64)
+    return (np.concatenate(arrays) if arrays else np.zeros((0, 3))), counts
 
-        if line[0] == "MEASURED":
-            datapoints.append([float(line[1]), float(line[2]), 0.0])
 
-    return np.array(datapoints)
+def read_measured_points(filename):
+    # read txt file points
+    limbs = read_limb_files(filename, fitshape=False, split=False)
+    if not limbs.meta["ok"][0]:
+        raise ValueError(f"could not parse points in {filename}")
+    return limbs.measured_points(0)
 
 
 ###############################################
@@ -208,17 +433,130 @@ def fit_parabola(x, y):
 
 
 ########################################
+def _local_maxima_rows(x, d, nxt):
+    # local maxima of each row of x as scipy.signal.find_peaks: a flat peak
+    # is placed at the middle of the plateau, the first and last samples are never peaks.
+    # d is np.diff(x), nxt[i] the first k >= i with d[k] != 0 (L-1 if none).
+    L = x.shape[1]
+    start = np.arange(1, L - 1)[None, :]
+    end = nxt[:, 1:]  # last sample of the plateau starting at each i
+    is_peak = (d[:, :-1] > 0) & (end < L - 1)
+    is_peak &= d[np.arange(len(d))[:, None], np.minimum(end, L - 2)] < 0
+    return is_peak, (start + end) // 2
+
+
+def _select_extrema_1d(x, y, is_peak, pos, n, distance):
+    # _select_extrema() for a single profile, cheaper on small arrays
+    pp = pos[is_peak]
+    if len(pp) > 1 and (np.diff(pp) < distance).any():
+        keep = np.ones(len(pp), dtype=bool)
+        for j in np.argsort(x[pp], kind="stable")[::-1]:
+            if keep[j]:
+                close = np.abs(pp - pp[j]) < distance
+                close[j] = False
+                keep &= ~close
+        pp = pp[keep]
+    if len(pp) > n:
+        pp = np.sort(pp[np.argsort(y[pp], kind="stable")[::-1][:n]])
+    ids = np.zeros((1, n), dtype=int)
+    mask = np.zeros((1, n), dtype=bool)
+    ids[0, : len(pp)] = pp
+    mask[0, : len(pp)] = True
+    return ids, mask
+
+
+def _select_extrema(x, y, is_peak, pos, n, distance):
+    # keep peaks at least distance apart, highest x first (as find_peaks),
+    # then the n with the largest y, returned in index order.
+    # Exact ties go to the later peak in both steps, as find_peaks and the
+    # descending sort of the heights do.
+    distance = np.ceil(distance)
+    N, L = x.shape
+    if N == 1:
+        return _select_extrema_1d(x[0], y[0], is_peak[0], pos[0], n, distance)
+    rows = np.arange(N)
+    counts = is_peak.sum(axis=1)
+    K = max(int(counts.max()) if N else 0, 1)
+    order = np.argsort(~is_peak, axis=1, kind="stable")[:, :K]  # peaks first, in index order
+    pp = pos[rows[:, None], order]
+    keep = is_peak[rows[:, None], order]
+
+    # only rows with two peaks closer than distance need the suppression loop
+    crowded = ((np.diff(pp, axis=1) < distance) & keep[:, 1:]).any(axis=1)
+    if crowded.any():
+        sub = np.flatnonzero(crowded)
+        spp, skeep, srows = pp[sub], keep[sub], np.arange(len(sub))
+        priority = np.where(skeep, x[sub[:, None], spp], -np.inf)
+        rank = np.argsort(priority, axis=1, kind="stable")[:, ::-1]
+        for r in range(int(counts[sub].max())):
+            j = rank[:, r]
+            active = skeep[srows, j]
+            close = np.abs(spp - spp[srows, j][:, None]) < distance
+            close[srows, j] = False
+            skeep &= ~(close & active[:, None])
+        keep[sub] = skeep
+
+    values = np.where(keep, y[rows[:, None], pp], -np.inf)
+    if K > n:
+        top = np.argsort(values, axis=1, kind="stable")[:, ::-1][:, :n]
+    else:
+        top = np.broadcast_to(np.arange(K), (N, K))
+    ids = pp[rows[:, None], top]
+    mask = keep[rows[:, None], top]
+    srt = np.argsort(np.where(mask, ids, L), axis=1, kind="stable")
+    ids = ids[rows[:, None], srt]
+    mask = mask[rows[:, None], srt]
+    if K < n:
+        ids = np.pad(ids, ((0, 0), (0, n - K)))
+        mask = np.pad(mask, ((0, 0), (0, n - K)))
+    return np.where(mask, ids, 0), mask
+
+
+def extrema_rows(profiles, n_peaks=5, n_valleys=6, distance=20):
+    """Peaks and valleys of each row of a (N, L) array of profiles, from a single pass.
+
+    Returns peak_ids (N, n_peaks), peak_mask, valley_ids (N, n_valleys), valley_mask:
+    the indices of the n largest peaks (valleys) at least distance apart, in
+    index order, with a mask of the valid entries. Same selection as
+    scipy.signal.find_peaks(distance=...) followed by a descending sort of
+    the peak heights; exact ties in height go to the later peak.
+    """
+    y = np.atleast_2d(np.asarray(profiles, dtype=float))
+    L = y.shape[1]
+    d = np.diff(y, axis=1)
+    changes = np.where(d != 0, np.arange(L - 1), L - 1)
+    nxt = np.minimum.accumulate(changes[:, ::-1], axis=1)[:, ::-1]
+    is_peak, pos = _local_maxima_rows(y, d, nxt)
+    peaks = _select_extrema(y, y, is_peak, pos, n_peaks, distance)
+    is_valley, pos = _local_maxima_rows(-y, -d, nxt)
+    valleys = _select_extrema(-y, y, is_valley, pos, n_valleys, distance)
+    return peaks + valleys
+
+
 def find_extrema(data, n=5, distance=20, invert=False):
-    # find the n largest peaks or valleys
+    # find the n largest peaks or valleys (largest in data value, also for valleys),
+    # returns their indices and the (k, 2) array of [index, value] in index order
+    data = np.asarray(data, dtype=float)
     if invert:
-        peak_ids = signal.find_peaks(-data, distance=distance)[0]
+        _, _, ids, mask = extrema_rows(data[None], 1, n, distance)
     else:
-        peak_ids = signal.find_peaks(data, distance=distance)[0]
-    peak_x = peak_ids
-    peak_y = data[peak_ids]
-    peaks = np.c_[peak_x, peak_y]
-    peaks = sort_by_column(peaks, 1, invert=True)[:n]
-    peaks = sort_by_column(peaks, 0)
-    peak_x, peak_y = peaks.T
-    peak_ids = peak_x.astype(int)
-    return peak_ids, peaks
+        ids, mask, _, _ = extrema_rows(data[None], n, 1, distance)
+    peak_ids = ids[0][mask[0]]
+    return peak_ids, np.c_[peak_ids, data[peak_ids]]
+
+
+########################################
+def parallel_map(func, items, workers=None, chunksize=None):
+    # apply func to all items in a pool of processes, results keep the input order
+    # so that the output does not depend on the number of workers.
+    # workers=None uses all cores, workers=1 runs serially in this process.
+    items = list(items)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(items))
+    if workers <= 1:
+        return [func(item) for item in items]
+    if chunksize is None:
+        chunksize = max(1, len(items) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, items, chunksize=chunksize))